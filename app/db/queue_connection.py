@@ -1,10 +1,36 @@
 from redis.asyncio import Redis
 import json
 import os
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
-QUEUE_NAME = "job_queue"
+QUEUE_NAME = "job_queue"                         # legacy single list; drained by dequeue
+PROCESSING_QUEUE = f"{QUEUE_NAME}:processing"   # delivery tokens currently held by a worker
+LEASES_KEY = f"{QUEUE_NAME}:leases"              # zset: delivery token -> lease deadline
+DELIVERIES_KEY = f"{QUEUE_NAME}:deliveries"      # hash: delivery token -> raw payload
+ATTEMPTS_KEY = f"{QUEUE_NAME}:attempts"          # hash: job_id -> delivery count
+DEAD_LETTER_QUEUE = f"{QUEUE_NAME}:dead"
+INFLIGHT_KEY = f"{QUEUE_NAME}:inflight"          # hash: user_id -> jobs leased
+SIGNAL_KEY = f"{QUEUE_NAME}:signal"              # wake-up tokens for idle workers
+TICK_KEY = f"{QUEUE_NAME}:tick"
+
+# Scheduling: every user has a sub-queue per lane
+# (job_queue:user:{lane}:{user_id}) and each lane has a ring of users with
+# work (job_queue:ready:{lane}). Dequeue serves the rings round-robin, one
+# job per user per turn, interactive before bulk, with every
+# QUEUE_BULK_EVERY-th dequeue trying bulk first so it can't starve. Users at
+# QUEUE_USER_INFLIGHT_CAP are parked until one of their jobs finishes.
+LANES = ("interactive", "bulk")
+USER_INFLIGHT_CAP = int(os.getenv("QUEUE_USER_INFLIGHT_CAP", "2"))
+# A user with this many jobs queued or running has further jobs put on the bulk lane
+BULK_THRESHOLD = int(os.getenv("QUEUE_BULK_THRESHOLD", "5"))
+BULK_EVERY = int(os.getenv("QUEUE_BULK_EVERY", "4"))
+SIGNAL_MAX = 1000
+
+VISIBILITY_TIMEOUT = int(os.getenv("QUEUE_VISIBILITY_TIMEOUT", "300"))
+MAX_ATTEMPTS = int(os.getenv("QUEUE_MAX_ATTEMPTS", "3"))
+DEQUEUE_BLOCK_TIMEOUT = int(os.getenv("QUEUE_BLOCK_TIMEOUT", "5"))
 
 # Use Upstash Redis instead of local Valkey
 REDIS_URL = os.getenv(
@@ -15,17 +41,285 @@ redis_conn = Redis.from_url(REDIS_URL, decode_responses=True)
 print("[Worker] Connected to Upstash Redis ✅")
 
 
-async def enqueue_job(job_data):
-    """Push a new job to the queue"""
-    await redis_conn.rpush(QUEUE_NAME, json.dumps(job_data))
-    print(f"[Worker] Job enqueued: {job_data['job_id']}")
+# Per-user and per-lane keys are derived from the queue name passed in ARGV,
+# so these scripts assume a single (non-cluster) Redis, as the rest of the app does.
+# Every delivery is leased under its own token ({job_id}:{n}), which is the
+# receipt handed to the worker. Once a lease expires and the job is
+# redelivered, the old token is gone, so a late ack, nack or heartbeat from
+# the first worker can't touch the new delivery.
+_SCHEDULER_LIB = """
+local function job_fields(raw)
+    local ok, job = pcall(cjson.decode, raw)
+    if not ok then
+        return raw, 'anonymous', 'interactive'
+    end
+    local user_id = job['user_id']
+    if type(user_id) ~= 'string' then user_id = 'anonymous' end
+    local lane = job['lane']
+    if lane ~= 'bulk' then lane = 'interactive' end
+    local job_id = job['job_id']
+    if type(job_id) ~= 'string' then job_id = raw end
+    return job_id, user_id, lane
+end
+
+local function signal(prefix, max_signals)
+    redis.call('LPUSH', prefix .. ':signal', '1')
+    redis.call('LTRIM', prefix .. ':signal', 0, max_signals - 1)
+end
+
+-- Put the user back in the rings of lanes where they have work, if not capped
+local function activate(prefix, user_id, cap, max_signals)
+    local inflight = tonumber(redis.call('HGET', prefix .. ':inflight', user_id) or '0')
+    if inflight >= cap then
+        return
+    end
+    for _, lane in ipairs({'interactive', 'bulk'}) do
+        local ring = prefix .. ':ready:' .. lane
+        if redis.call('LLEN', prefix .. ':user:' .. lane .. ':' .. user_id) > 0
+            and redis.call('SADD', ring .. ':members', user_id) == 1 then
+            redis.call('RPUSH', ring, user_id)
+            signal(prefix, max_signals)
+        end
+    end
+end
+
+local function release(prefix, user_id)
+    if redis.call('HINCRBY', prefix .. ':inflight', user_id, -1) <= 0 then
+        redis.call('HDEL', prefix .. ':inflight', user_id)
+    end
+end
+"""
+
+# ARGV: prefix, payload, user_id, lane ('auto' = pick), cap, bulk threshold, max signals
+# An 'auto' payload starts with {"lane": "auto", ...}; the lane is filled in
+# textually because re-encoding with cjson would turn empty lists into {}.
+_ENQUEUE_SCRIPT = _SCHEDULER_LIB + """
+local prefix, raw, user_id, lane = ARGV[1], ARGV[2], ARGV[3], ARGV[4]
+if lane == 'auto' then
+    local load = tonumber(redis.call('HGET', prefix .. ':inflight', user_id) or '0')
+        + redis.call('LLEN', prefix .. ':user:interactive:' .. user_id)
+    lane = (load >= tonumber(ARGV[6])) and 'bulk' or 'interactive'
+    raw = string.gsub(raw, '^{"lane": "auto"', '{"lane": "' .. lane .. '"', 1)
+end
+redis.call('RPUSH', prefix .. ':user:' .. lane .. ':' .. user_id, raw)
+activate(prefix, user_id, tonumber(ARGV[5]), tonumber(ARGV[7]))
+signal(prefix, tonumber(ARGV[7]))
+return lane
+"""
+
+# KEYS: processing, leases, attempts, deliveries, legacy queue
+# ARGV: prefix, now, visibility, cap, bulk every
+# Returns {payload, attempts, token} or nil
+_DEQUEUE_SCRIPT = _SCHEDULER_LIB + """
+local prefix, cap = ARGV[1], tonumber(ARGV[4])
+
+local function lease(raw)
+    local job_id, user_id = job_fields(raw)
+    local token = job_id .. ':' .. redis.call('INCR', prefix .. ':delivery_seq')
+    redis.call('HINCRBY', prefix .. ':inflight', user_id, 1)
+    redis.call('HSET', KEYS[4], token, raw)
+    redis.call('RPUSH', KEYS[1], token)
+    redis.call('ZADD', KEYS[2], tonumber(ARGV[2]) + tonumber(ARGV[3]), token)
+    return {raw, redis.call('HINCRBY', KEYS[3], job_id, 1), token}
+end
+
+local lanes = {'interactive', 'bulk'}
+local bulk_every = tonumber(ARGV[5])
+if bulk_every > 0 and redis.call('INCR', prefix .. ':tick') % bulk_every == 0 then
+    lanes = {'bulk', 'interactive'}
+end
+
+for _, lane in ipairs(lanes) do
+    local ring = prefix .. ':ready:' .. lane
+    for _ = 1, redis.call('LLEN', ring) do
+        local user_id = redis.call('LPOP', ring)
+        local queue = prefix .. ':user:' .. lane .. ':' .. user_id
+        local inflight = tonumber(redis.call('HGET', prefix .. ':inflight', user_id) or '0')
+        local raw = nil
+        if inflight < cap then
+            raw = redis.call('LPOP', queue)
+        end
+        if raw and redis.call('LLEN', queue) > 0 and inflight + 1 < cap then
+            -- More work and room to run it: back of the ring for the next turn
+            redis.call('RPUSH', ring, user_id)
+        else
+            -- Drained or capped: parked until enqueue/ack activates the user again
+            redis.call('SREM', ring .. ':members', user_id)
+        end
+        if raw then
+            return lease(raw)
+        end
+    end
+end
+
+-- Jobs enqueued (or reclaimed) before per-user queues existed
+local raw = redis.call('LPOP', KEYS[5])
+if raw then
+    return lease(raw)
+end
+return nil
+"""
+
+# KEYS: processing, leases, attempts, deliveries
+# ARGV: prefix, token, requeue ('1'/'0'), cap, max signals
+# Ends a lease; with requeue the job goes back to the front of its user's queue
+# and the delivery isn't counted. A stale token (the lease was reclaimed) is a no-op.
+_FINISH_SCRIPT = _SCHEDULER_LIB + """
+local token = ARGV[2]
+local raw = redis.call('HGET', KEYS[4], token)
+if not raw or redis.call('LREM', KEYS[1], 1, token) == 0 then
+    return 0
+end
+local job_id, user_id, lane = job_fields(raw)
+redis.call('ZREM', KEYS[2], token)
+redis.call('HDEL', KEYS[4], token)
+release(ARGV[1], user_id)
+if ARGV[3] == '1' then
+    redis.call('HINCRBY', KEYS[3], job_id, -1)
+    redis.call('LPUSH', ARGV[1] .. ':user:' .. lane .. ':' .. user_id, raw)
+else
+    redis.call('HDEL', KEYS[3], job_id)
+end
+activate(ARGV[1], user_id, tonumber(ARGV[4]), tonumber(ARGV[5]))
+return 1
+"""
+
+# Moves leases that ran past their deadline back to the front of their
+# user's queue, or onto the dead-letter list once a job has been delivered
+# MAX_ATTEMPTS times. Jobs that sit in the processing list without a lease
+# (left by the old two-step dequeue) are given one so the next pass can
+# reclaim them. Leases taken before delivery tokens existed are keyed by
+# the raw payload itself.
+# KEYS: processing, leases, attempts, deliveries, dead
+# ARGV: prefix, now, max_attempts, visibility, cap, max signals
+_RECLAIM_SCRIPT = _SCHEDULER_LIB + """
+local prefix = ARGV[1]
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[2], 'LIMIT', 0, 100)
+local requeued = 0
+local dead = {}
+for _, token in ipairs(expired) do
+    redis.call('ZREM', KEYS[2], token)
+    local raw = redis.call('HGET', KEYS[4], token) or token
+    redis.call('HDEL', KEYS[4], token)
+    if redis.call('LREM', KEYS[1], 1, token) > 0 then
+        local job_id, user_id, lane = job_fields(raw)
+        release(prefix, user_id)
+        local attempts = tonumber(redis.call('HGET', KEYS[3], job_id) or '0')
+        if attempts >= tonumber(ARGV[3]) then
+            redis.call('RPUSH', KEYS[5], raw)
+            redis.call('HDEL', KEYS[3], job_id)
+            table.insert(dead, raw)
+        else
+            redis.call('LPUSH', prefix .. ':user:' .. lane .. ':' .. user_id, raw)
+            requeued = requeued + 1
+        end
+        activate(prefix, user_id, tonumber(ARGV[5]), tonumber(ARGV[6]))
+    end
+end
+for _, token in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+    if not redis.call('ZSCORE', KEYS[2], token) then
+        redis.call('ZADD', KEYS[2], tonumber(ARGV[2]) + tonumber(ARGV[4]), token)
+    end
+end
+return {requeued, dead}
+"""
+_enqueue = redis_conn.register_script(_ENQUEUE_SCRIPT)
+_dequeue = redis_conn.register_script(_DEQUEUE_SCRIPT)
+_finish = redis_conn.register_script(_FINISH_SCRIPT)
+_reclaim = redis_conn.register_script(_RECLAIM_SCRIPT)
+
+_LEASE_KEYS = [PROCESSING_QUEUE, LEASES_KEY, ATTEMPTS_KEY, DELIVERIES_KEY]
+
+
+async def enqueue_job(job_data, lane: str | None = None):
+    """
+    Add a job to its user's queue. `lane` is "interactive" or "bulk"; by
+    default users with QUEUE_BULK_THRESHOLD jobs queued or running are
+    moved to bulk so one heavy submitter can't delay everyone else.
+    """
+    if lane is not None and lane not in LANES:
+        raise ValueError(f"Unknown queue lane: {lane}")
+    lane = lane or "auto"
+    lane = await _enqueue(
+        keys=[],
+        args=[
+            QUEUE_NAME,
+            json.dumps({"lane": lane, **{k: v for k, v in job_data.items() if k != "lane"}}),
+            job_data.get("user_id") or "anonymous",
+            lane,
+            USER_INFLIGHT_CAP,
+            BULK_THRESHOLD,
+            SIGNAL_MAX,
+        ],
+    )
+    print(f"[Worker] Job enqueued: {job_data['job_id']} ({lane})")
+
+
+async def _lease_next():
+    leased = await _dequeue(
+        keys=_LEASE_KEYS + [QUEUE_NAME],
+        args=[QUEUE_NAME, time.time(), VISIBILITY_TIMEOUT, USER_INFLIGHT_CAP, BULK_EVERY],
+    )
+    if not leased:
+        return None
+    raw, attempts, token = leased
+    data = json.loads(raw)
+    print(f"[Worker] Dequeued job: {data['job_id']} ({data.get('lane', 'interactive')}, attempt {attempts})")
+    return data, token
+
+
+async def dequeue_job(timeout: int = DEQUEUE_BLOCK_TIMEOUT):
+    """
+    Lease the next job picked by the fair scheduler, waiting up to `timeout`
+    seconds for work when there is none.
+
+    The job is moved atomically into the processing list, so it survives a
+    worker crash. Returns `(job, receipt)`, where the receipt is this
+    delivery's lease token; pass it to `ack_job`, `nack_job` or
+    `extend_lease`. Returns None when no job could be leased.
+    """
+    leased = await _lease_next()
+    if leased:
+        return leased
+    # Idle: park on the signal list; enqueues and finished jobs push tokens
+    if not await redis_conn.blpop([SIGNAL_KEY], timeout):
+        return None
+    return await _lease_next()
+
+
+async def ack_job(receipt: str) -> bool:
+    """
+    Mark a leased job as finished and drop it from the processing list.
+    Returns False if the lease had already been reclaimed.
+    """
+    return bool(await _finish(keys=_LEASE_KEYS, args=[QUEUE_NAME, receipt, "0", USER_INFLIGHT_CAP, SIGNAL_MAX]))
+
+
+async def nack_job(receipt: str) -> bool:
+    """
+    Return a leased job to the front of its user's queue without counting
+    the delivery, e.g. when the worker is shutting down mid-job. A reclaimed
+    lease is left alone (the job is already queued again); returns False then.
+    """
+    return bool(await _finish(keys=_LEASE_KEYS, args=[QUEUE_NAME, receipt, "1", USER_INFLIGHT_CAP, SIGNAL_MAX]))
+
+
+async def extend_lease(receipt: str) -> bool:
+    """
+    Push a running job's lease deadline out by another VISIBILITY_TIMEOUT.
+    Only an existing lease is extended, and the token is per delivery, so a
+    reclaimed lease is never revived. Returns False if the lease is gone.
+    """
+    return bool(await redis_conn.zadd(LEASES_KEY, {receipt: time.time() + VISIBILITY_TIMEOUT}, xx=True, ch=True))
 
 
-async def dequeue_job():
-    """Pop a job from the queue"""
-    job_data = await redis_conn.lpop(QUEUE_NAME)
-    if job_data:
-        data = json.loads(job_data)
-        print(f"[Worker] Dequeued job: {data['job_id']}")
-        return data
-    return None
+async def reclaim_expired_jobs():
+    """
+    Re-queue jobs whose lease expired. Returns `(requeued_count, dead_jobs)`
+    where `dead_jobs` are the payloads moved to the dead-letter list.
+    """
+    requeued, dead = await _reclaim(
+        keys=_LEASE_KEYS + [DEAD_LETTER_QUEUE],
+        args=[QUEUE_NAME, time.time(), MAX_ATTEMPTS, VISIBILITY_TIMEOUT, USER_INFLIGHT_CAP, SIGNAL_MAX],
+    )
+    return int(requeued), [json.loads(raw) for raw in dead]
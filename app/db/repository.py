@@ -0,0 +1,197 @@
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Tuple, TypedDict
+import httpx
+from postgrest import AsyncPostgrestClient
+from postgrest.constants import DEFAULT_POSTGREST_CLIENT_HEADERS
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger("coverly.db")
+
+# Async PostgREST access for every table we own. Queries share one HTTP/2
+# pool per process, so DB latency is spent awaiting sockets instead of
+# holding event-loop time or threadpool slots.
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", "20"))
+DB_TIMEOUT = float(os.getenv("DB_TIMEOUT", "15"))
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "500"))
+
+
+class ThumbnailPrompt(TypedDict, total=False):
+    job_id: str
+    user_id: str
+    provider: str
+    user_query: str
+    refined_prompt: str
+    title: str
+    reference_images: List[str]
+    reference_image_hashes: List[str]
+    youtube_examples: List[str]
+    generated_images: List[str]
+    generated_images_gemini: List[str]
+    aspect_ratio: str
+    platform: str
+    generator_provider: str
+    status: str
+    credits_consumed: int
+    node_timings: Dict[str, int]
+    created_at: str
+
+
+# PostgREST rewrites base_url and headers on the client it is handed, so
+# this pool is private to the DB and never shared with provider clients.
+_http: httpx.AsyncClient | None = None
+_db: AsyncPostgrestClient | None = None
+
+# query name -> [calls, total ms, max ms]
+_query_stats: Dict[str, List[float]] = {}
+
+
+def get_db() -> AsyncPostgrestClient:
+    global _http, _db
+    if _db is None or _http is None or _http.is_closed:
+        _http = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(DB_TIMEOUT, connect=5.0),
+            limits=httpx.Limits(
+                max_connections=DB_MAX_CONNECTIONS,
+                max_keepalive_connections=DB_MAX_CONNECTIONS,
+            ),
+            follow_redirects=True,
+        )
+        _db = AsyncPostgrestClient(
+            f"{SUPABASE_URL}/rest/v1",
+            headers={
+                **DEFAULT_POSTGREST_CLIENT_HEADERS,
+                "apikey": SUPABASE_SERVICE_KEY,
+                "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
+            },
+            http_client=_http,
+        )
+    return _db
+
+
+async def close_db():
+    global _http, _db
+    if _http is not None:
+        await _http.aclose()
+    _http = _db = None
+
+
+async def _execute(name: str, query):
+    started = time.perf_counter()
+    try:
+        return await query.execute()
+    finally:
+        elapsed = (time.perf_counter() - started) * 1000
+        stats = _query_stats.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+        if elapsed > DB_SLOW_QUERY_MS:
+            logger.warning(f"Slow query {name}: {elapsed:.0f}ms")
+
+
+def db_stats() -> Dict[str, Dict[str, float]]:
+    """Per-query call counts and latencies (ms) since process start."""
+    return {
+        name: {"calls": calls, "avg_ms": round(total / calls, 1), "max_ms": round(peak, 1)}
+        for name, (calls, total, peak) in _query_stats.items()
+    }
+
+
+# ----------------------
+# thumbnail_prompts
+# ----------------------
+async def insert_prompt(record: ThumbnailPrompt) -> List[ThumbnailPrompt]:
+    res = await _execute("insert_prompt", get_db().table("thumbnail_prompts").insert(record))
+    return res.data
+
+
+async def get_prompt(job_id: str) -> Optional[ThumbnailPrompt]:
+    res = await _execute(
+        "get_prompt",
+        get_db().table("thumbnail_prompts").select("*").eq("job_id", job_id).limit(1),
+    )
+    return res.data[0] if res.data else None
+
+
+async def update_prompt(job_id: str, data: ThumbnailPrompt):
+    await _execute(
+        "update_prompt",
+        get_db().table("thumbnail_prompts").update(data, returning="minimal").eq("job_id", job_id),
+    )
+
+
+# Columns the gallery renders; the heavy JSONB prompt/reference columns stay in the DB
+HISTORY_COLUMNS = "job_id, created_at, title, user_query, platform, aspect_ratio, status, generated_images, generated_images_gemini"
+
+
+async def list_prompt_page(
+    user_id: str, limit: int, after: Optional[Tuple[str, str]] = None
+) -> List[ThumbnailPrompt]:
+    """
+    One page of a user's history, newest first. `after` is the
+    (created_at, job_id) of the last row already seen; keyset paging keeps
+    every page an index range scan, however deep the client pages.
+    """
+    query = (
+        get_db().table("thumbnail_prompts")
+        .select(HISTORY_COLUMNS)
+        .eq("user_id", user_id)
+    )
+    if after:
+        created_at, job_id = after
+        query = query.or_(
+            f'created_at.lt."{created_at}",and(created_at.eq."{created_at}",job_id.lt."{job_id}")'
+        )
+    query = query.order("created_at", desc=True).order("job_id", desc=True).limit(limit)
+    res = await _execute("list_prompt_page", query)
+    return res.data
+
+
+async def latest_generated_images(user_id: str, limit: int) -> List[ThumbnailPrompt]:
+    res = await _execute(
+        "latest_generated_images",
+        get_db().table("thumbnail_prompts")
+        .select("generated_images, generated_images_gemini")
+        .eq("user_id", user_id)
+        .order("created_at", desc=True)
+        .limit(limit),
+    )
+    return res.data
+
+
+# ----------------------
+# user_credits
+# ----------------------
+async def get_credit_balance(user_id: str) -> Optional[int]:
+    res = await _execute(
+        "get_credit_balance",
+        get_db().table("user_credits").select("credits").eq("user_id", user_id).limit(1),
+    )
+    return res.data[0]["credits"] if res.data else None
+
+
+async def create_credit_balance(user_id: str, credits: int):
+    # Ignore duplicates: two first requests from one user may race here
+    await _execute(
+        "create_credit_balance",
+        get_db().table("user_credits").upsert(
+            {"user_id": user_id, "credits": credits},
+            on_conflict="user_id",
+            ignore_duplicates=True,
+            returning="minimal",
+        ),
+    )
+
+
+async def save_credit_balances(rows: List[Dict]):
+    """Bulk write of {"user_id", "credits"} rows."""
+    await _execute(
+        "save_credit_balances",
+        get_db().table("user_credits").upsert(rows, on_conflict="user_id", returning="minimal"),
+    )
@@ -1,64 +1,54 @@
-import boto3
-import os
+import asyncio
+import hashlib
 import logging
 from botocore.exceptions import NoCredentialsError, ClientError
 from dotenv import load_dotenv
+from .storage import get_storage
 
 load_dotenv()
 logger = logging.getLogger("coverly.s3")
 
-AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
-AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
-AWS_REGION = os.getenv("AWS_REGION", "ap-south-1")
-S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
+UPLOAD_CHUNK_SIZE = 1024 * 1024
 
-if not all([AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, S3_BUCKET_NAME]):
-    logger.warning("⚠️ Missing AWS credentials or S3 bucket name!")
 
-s3_client = boto3.client(
-    "s3",
-    aws_access_key_id=AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-    region_name=AWS_REGION,
-    endpoint_url=f"https://s3.{AWS_REGION}.amazonaws.com",
-)
+def _hash_file(file_obj) -> tuple[str, int]:
+    """SHA-256 and size of a file object, read in chunks. Rewinds afterwards."""
+    file_obj.seek(0)
+    digest = hashlib.sha256()
+    size = 0
+    while chunk := file_obj.read(UPLOAD_CHUNK_SIZE):
+        digest.update(chunk)
+        size += len(chunk)
+    file_obj.seek(0)
+    return digest.hexdigest(), size
 
 
 async def upload_to_s3(job_id: str, file_obj, filename: str, content_type: str = "image/jpeg"):
     """
-    Upload a file object to S3 and return a presigned URL.
-    Ensures file data is read safely and logged properly.
+    Upload a file object to S3 and return its presigned URL, key and SHA-256.
+
+    The content hash is computed in a chunked pass before the upload and
+    stored as `sha256` object metadata, so cache keys can be built later
+    without downloading the image again. The upload itself streams the file
+    (multipart above the storage threshold). Returns None on failure.
     """
     try:
-        if not S3_BUCKET_NAME:
-            raise ValueError("S3_BUCKET_NAME environment variable is not set.")
+        storage = get_storage("uploads")
         if not filename:
             raise ValueError("Missing filename for upload.")
         if file_obj is None:
             raise ValueError("File object is None.")
 
-        file_obj.seek(0)
-        file_bytes = file_obj.read()
-        if not file_bytes:
+        content_hash, size = await asyncio.to_thread(_hash_file, file_obj)
+        if not size:
             raise ValueError(f"File '{filename}' is empty or unreadable.")
 
         file_key = f"{job_id}/{filename}"
-
-        s3_client.put_object(
-            Bucket=S3_BUCKET_NAME,
-            Key=file_key,
-            Body=file_bytes,
-            ContentType=content_type,
-        )
-
-        signed_url = s3_client.generate_presigned_url(
-            "get_object",
-            Params={"Bucket": S3_BUCKET_NAME, "Key": file_key},
-            ExpiresIn=60 * 60 * 24 * 7,  # 1 week
-        )
+        await storage.put_fileobj(file_key, file_obj, content_type, metadata={"sha256": content_hash})
+        signed_url = storage.presign(file_key)
 
         logger.info(f"[S3 Upload ✅] {filename} uploaded successfully.")
-        return signed_url
+        return {"url": signed_url, "key": file_key, "sha256": content_hash}
 
     except (NoCredentialsError, ClientError, ValueError, Exception) as e:
         logger.error(f"[S3 Upload ❌] {filename or 'unknown'} failed: {e}")
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, Optional
+from urllib.parse import quote
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger("coverly.storage")
+
+# "s3" in production; "local" writes to disk for benchmarks and tests
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "s3").lower()
+AWS_REGION = os.getenv("AWS_REGION", "ap-south-1")
+STORAGE_MAX_WORKERS = int(os.getenv("STORAGE_MAX_WORKERS", "16"))
+MULTIPART_THRESHOLD = int(os.getenv("STORAGE_MULTIPART_THRESHOLD", str(8 * 1024 * 1024)))
+MULTIPART_CHUNK_SIZE = int(os.getenv("STORAGE_MULTIPART_CHUNK_SIZE", str(8 * 1024 * 1024)))
+LOCAL_STORAGE_ROOT = os.getenv("LOCAL_STORAGE_ROOT", "./.local_storage")
+LOCAL_STORAGE_BASE_URL = os.getenv("LOCAL_STORAGE_BASE_URL", "http://localhost:8000/local-storage")
+DEFAULT_URL_EXPIRY = 60 * 60 * 24 * 7  # 1 week
+
+# Buckets by role: user uploads (reference images) and generated thumbnails
+BUCKETS = {
+    "uploads": os.getenv("S3_BUCKET_NAME"),
+    "generated": os.getenv("S3_CACHED_BUCKET_NAME"),
+}
+BUCKET_ACLS = {"generated": "private"}
+
+# boto3 is blocking; all S3 network calls run on this bounded pool so they
+# never stall the event loop or starve the default executor.
+_executor = ThreadPoolExecutor(max_workers=STORAGE_MAX_WORKERS, thread_name_prefix="storage")
+
+
+async def _run(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, lambda: fn(*args, **kwargs))
+
+
+class S3Storage:
+    """S3 bucket backend. One shared, thread-safe boto3 client per process."""
+
+    _client = None
+
+    def __init__(self, bucket: str, acl: Optional[str] = None):
+        self.bucket = bucket
+        self.acl = acl
+
+    def _extra_args(self, content_type: str, metadata: Optional[dict]) -> dict:
+        extra = {"ContentType": content_type, "Metadata": metadata or {}}
+        if self.acl:
+            extra["ACL"] = self.acl
+        return extra
+
+    @classmethod
+    def client(cls):
+        if cls._client is None:
+            cls._client = boto3.client(
+                "s3",
+                aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+                aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+                region_name=AWS_REGION,
+                endpoint_url=f"https://s3.{AWS_REGION}.amazonaws.com",
+                config=Config(max_pool_connections=STORAGE_MAX_WORKERS, retries={"mode": "adaptive"}),
+            )
+        return cls._client
+
+    async def put_bytes(self, key: str, data: bytes, content_type: str, metadata: Optional[dict] = None):
+        await _run(
+            self.client().put_object,
+            Bucket=self.bucket,
+            Key=key,
+            Body=data,
+            **self._extra_args(content_type, metadata),
+        )
+
+    async def put_fileobj(self, key: str, file_obj: BinaryIO, content_type: str, metadata: Optional[dict] = None):
+        """Stream a file object; objects above the threshold use multipart upload."""
+        await _run(
+            self.client().upload_fileobj,
+            file_obj,
+            self.bucket,
+            key,
+            ExtraArgs=self._extra_args(content_type, metadata),
+            Config=TransferConfig(
+                multipart_threshold=MULTIPART_THRESHOLD,
+                multipart_chunksize=MULTIPART_CHUNK_SIZE,
+                use_threads=False,  # already on the storage pool
+            ),
+        )
+
+    def presign(self, key: str, expires_in: int = DEFAULT_URL_EXPIRY, filename: Optional[str] = None) -> str:
+        """Sign a GET URL. Signing is local computation, no network call."""
+        params = {"Bucket": self.bucket, "Key": key}
+        if filename:
+            params["ResponseContentDisposition"] = f'attachment; filename="{filename}"'
+        return self.client().generate_presigned_url("get_object", Params=params, ExpiresIn=expires_in)
+
+
+class LocalStorage:
+    """
+    Filesystem stand-in with the same interface, rooted at LOCAL_STORAGE_ROOT.
+    URLs point at the API's /local-storage static mount and never expire.
+    """
+
+    def __init__(self, bucket: str):
+        self.bucket = bucket or "default"
+        self.root = Path(LOCAL_STORAGE_ROOT) / self.bucket
+
+    def _path(self, key: str) -> Path:
+        path = (self.root / key).resolve()
+        if self.root.resolve() not in path.parents:
+            raise ValueError(f"Invalid storage key: {key}")
+        return path
+
+    def _write(self, key: str, data: bytes, metadata: Optional[dict]):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        if metadata:
+            path.with_name(path.name + ".meta").write_text(
+                "\n".join(f"{k}={v}" for k, v in metadata.items())
+            )
+
+    async def put_bytes(self, key: str, data: bytes, content_type: str, metadata: Optional[dict] = None):
+        await asyncio.to_thread(self._write, key, data, metadata)
+
+    async def put_fileobj(self, key: str, file_obj: BinaryIO, content_type: str, metadata: Optional[dict] = None):
+        await asyncio.to_thread(lambda: self._write(key, file_obj.read(), metadata))
+
+    def presign(self, key: str, expires_in: int = DEFAULT_URL_EXPIRY, filename: Optional[str] = None) -> str:
+        return f"{LOCAL_STORAGE_BASE_URL}/{self.bucket}/{quote(key)}"
+
+
+_storages: dict = {}
+
+
+def get_storage(role: str):
+    """Storage backend for a bucket role ("uploads" or "generated")."""
+    if role not in _storages:
+        bucket = BUCKETS[role]
+        if STORAGE_BACKEND == "local":
+            _storages[role] = LocalStorage(bucket or role)
+        else:
+            if not bucket:
+                logger.warning(f"⚠️ No S3 bucket configured for '{role}' storage!")
+            _storages[role] = S3Storage(bucket, acl=BUCKET_ACLS.get(role))
+    return _storages[role]
@@ -1,10 +1,33 @@
+import asyncio
 import os
+from concurrent.futures import ThreadPoolExecutor
 from supabase import create_client
 from dotenv import load_dotenv
 
-load_dotenv() 
+load_dotenv()
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")  
+SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY")
+SUPABASE_SYNC_WORKERS = int(os.getenv("SUPABASE_SYNC_WORKERS", "4"))
+
+# The one service-role client. Table access goes through app.db.repository;
+# this client is only used for the Auth admin API, which has no async path here.
 supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
 
+_anon_client = None
+# Blocking Supabase calls run on their own small pool, never the default executor
+_executor = ThreadPoolExecutor(max_workers=SUPABASE_SYNC_WORKERS, thread_name_prefix="supabase")
+
+
+def get_anon_client():
+    """Anon-key client for the browser OAuth flow (sign-in URLs only)."""
+    global _anon_client
+    if _anon_client is None:
+        _anon_client = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
+    return _anon_client
+
+
+async def run_sync(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, lambda: fn(*args, **kwargs))
@@ -1,19 +1,90 @@
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from supabase import create_client, Client
+from cachetools import TTLCache
+import asyncio
+import logging
 import os
-import jwt  
+import time
+import jwt
 from dotenv import load_dotenv
+from ..db.supabase_client import supabase, run_sync
 
 load_dotenv()
+logger = logging.getLogger("coverly.auth")
 
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")  
+SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
+
+# "claims": trust the verified JWT claims (Supabase embeds email and
+#           app_metadata), only looking the user up when they are missing.
+# "cached": always use the profile cache below.
+AUTH_PROFILE_MODE = os.getenv("AUTH_PROFILE_MODE", "claims").lower()
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+AUTH_CACHE_TTL = int(os.getenv("AUTH_CACHE_TTL", "3600"))
+AUTH_REFRESH_AFTER = int(os.getenv("AUTH_REFRESH_AFTER", "300"))
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
 security = HTTPBearer()
 
+# (sub, session_id, iat) -> (profile, fetched_at). A new login or refreshed
+# token carries a new session_id/iat, which naturally invalidates the entry.
+_profile_cache: TTLCache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
+_refreshing: set = set()
+
+
+def _profile_from_claims(decoded: dict) -> dict | None:
+    if not decoded.get("email") or "app_metadata" not in decoded:
+        return None
+    return {
+        "id": decoded["sub"],
+        "email": decoded["email"],
+        "app_metadata": decoded.get("app_metadata") or {},
+        "user_metadata": decoded.get("user_metadata") or {},
+    }
+
+
+async def _fetch_profile(user_id: str) -> dict:
+    user_resp = await run_sync(supabase.auth.admin.get_user_by_id, user_id)
+    user = user_resp.user
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User not found in Supabase",
+        )
+    return {
+        "id": user.id,
+        "email": user.email,
+        "app_metadata": user.app_metadata,
+        "user_metadata": user.user_metadata,
+    }
+
+
+async def _refresh_profile(cache_key: tuple, user_id: str):
+    try:
+        _profile_cache[cache_key] = (await _fetch_profile(user_id), time.monotonic())
+    except Exception as e:
+        logger.warning(f"Background profile refresh failed for {user_id}: {e}")
+        _profile_cache.pop(cache_key, None)
+    finally:
+        _refreshing.discard(cache_key)
+
+
+async def _cached_profile(decoded: dict) -> dict:
+    """
+    Profile from the TTL/LRU cache. Entries older than AUTH_REFRESH_AFTER are
+    served as-is while a background task refreshes them.
+    """
+    cache_key = (decoded["sub"], decoded.get("session_id"), decoded.get("iat"))
+    entry = _profile_cache.get(cache_key)
+    if entry is None:
+        profile = await _fetch_profile(decoded["sub"])
+        _profile_cache[cache_key] = (profile, time.monotonic())
+        return profile
+
+    profile, fetched_at = entry
+    if time.monotonic() - fetched_at > AUTH_REFRESH_AFTER and cache_key not in _refreshing:
+        _refreshing.add(cache_key)
+        asyncio.create_task(_refresh_profile(cache_key, decoded["sub"]))
+    return profile
+
 
 async def verify_supabase_token(
     credentials: HTTPAuthorizationCredentials = Depends(security),
@@ -27,22 +98,13 @@ async def verify_supabase_token(
             options={"verify_aud": False},  # optional
         )
 
-
-        user_resp = supabase.auth.admin.get_user_by_id(decoded["sub"])
-        user = user_resp.user
-
-        if not user:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="User not found in Supabase",
-            )
+        profile = _profile_from_claims(decoded) if AUTH_PROFILE_MODE == "claims" else None
+        if profile is None:
+            profile = await _cached_profile(decoded)
 
         return {
-            "id": user.id,
-            "email": user.email,
+            **profile,
             "role": decoded.get("role", "authenticated"),
-            "app_metadata": user.app_metadata,
-            "user_metadata": user.user_metadata,
         }
 
     except jwt.ExpiredSignatureError:
@@ -57,6 +119,9 @@ async def verify_supabase_token(
             detail="Invalid JWT token",
         )
 
+    except HTTPException:
+        raise
+
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
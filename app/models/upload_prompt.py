@@ -10,3 +10,9 @@ class UploadPromptRequest(BaseModel):
     remaining_credits: int = Field(..., description="User's remaining credits after this upload")
     job_id: str = Field(..., description="Unique identifier for the thumbnail generation job")
     user_id: str = Field(..., description="The UUID of the user uploading the prompt")
+    coalesced: bool = Field(False, description="True if the request was attached to an identical job instead of starting new work")
+    status: str = Field("queued", description="'completed' when the result was served from cache, else 'queued'")
+    generated_images: List[str] = Field(
+        default_factory=list,
+        description="Signed URLs of the generated images, filled in when status is 'completed'"
+    )
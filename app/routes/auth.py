@@ -1,17 +1,16 @@
-from fastapi import APIRouter, Request, Header, HTTPException
+from fastapi import APIRouter, Request, Depends
 from fastapi.responses import RedirectResponse, JSONResponse
-from supabase import create_client
 import os
 from dotenv import load_dotenv
+from ..db.supabase_client import get_anon_client
+from ..db.repository import insert_prompt
+from ..dependencies.auth import verify_supabase_token
+from ..services.history_cache import invalidate_history
 
 load_dotenv()
 
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY")
 REDIRECT_URL = os.getenv("REDIRECT_URL")
 
-supabase = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
-
 router = APIRouter()
 
 @router.get("/login")
@@ -19,7 +18,7 @@ def login():
     """
     Redirect user to Google sign-in via Supabase Auth.
     """
-    res = supabase.auth.sign_in_with_oauth({
+    res = get_anon_client().auth.sign_in_with_oauth({
         "provider": "google",
         "options": {"redirect_to": REDIRECT_URL}
     })
@@ -38,17 +37,8 @@ def callback():
 
 
 @router.post("/add-thumbnail")
-async def add_thumbnail(request: Request, authorization: str = Header(None)):
-    if not authorization:
-        raise HTTPException(status_code=401, detail="Missing Authorization header")
-
-    token = authorization.replace("Bearer ", "").strip()
-    user_res = supabase.auth.get_user(jwt=token)
-
-    if not user_res.user:
-        raise HTTPException(status_code=401, detail="Invalid token")
-
-    user_id = user_res.user.id
+async def add_thumbnail(request: Request, user=Depends(verify_supabase_token)):
+    user_id = user["id"]
     body = await request.json()
 
     data = {
@@ -61,20 +51,7 @@ async def add_thumbnail(request: Request, authorization: str = Header(None)):
         "generated_images": body.get("generated_images", []),
     }
 
-    res = supabase.table("thumbnail_prompts").insert(data).execute()
-    return {"message": "Thumbnail saved ✅", "data": res.data}
-
-
-@router.get("/my-thumbnails")
-def get_my_thumbnails(authorization: str = Header(None)):
-    if not authorization:
-        raise HTTPException(status_code=401, detail="Missing Authorization header")
-
-    token = authorization.replace("Bearer ", "").strip()
-    user_res = supabase.auth.get_user(jwt=token)
-
-    if not user_res.user:
-        raise HTTPException(status_code=401, detail="Invalid token")
+    inserted = await insert_prompt(data)
+    await invalidate_history(user_id)
+    return {"message": "Thumbnail saved ✅", "data": inserted}
 
-    res = supabase.table("thumbnail_prompts").select("*").execute()
-    return res.data
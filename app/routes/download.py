@@ -1,37 +1,138 @@
-
-from fastapi import FastAPI, HTTPException,APIRouter
-from fastapi.responses import StreamingResponse
+from fastapi import HTTPException, APIRouter, Request, Query
+from fastapi.responses import StreamingResponse, RedirectResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
-import requests
-from io import BytesIO
+from typing import Literal, Optional
+from pathlib import PurePosixPath
+from datetime import datetime, timezone
+from urllib.parse import parse_qs, urlsplit, urlunsplit
+import httpx
+import logging
+import os
+import time
+from ..db.storage import get_storage
+from ..services.clients import get_http_client
+from ..services.url_signer import storage_key
 
+logger = logging.getLogger("coverly.api")
 router = APIRouter()
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_URL_TTL = int(os.getenv("DOWNLOAD_URL_TTL", "300"))
+# Upstream headers worth passing through to the client
+FORWARDED_HEADERS = ("content-length", "content-range", "accept-ranges", "etag", "last-modified", "content-type")
+
+
 class DownloadRequest(BaseModel):
     presigned_url: str
+    filename: Optional[str] = None
+    mode: Literal["proxy", "redirect"] = "proxy"
 
-@router.post("/download-photo/")
-def download_photo(request: DownloadRequest):
+
+def _signature_expiry(query: dict) -> Optional[float]:
+    """Expiry (epoch seconds) of a SigV4 or SigV2 presigned URL, or None if it isn't signed."""
+    if "X-Amz-Signature" in query:
+        try:
+            signed_at = datetime.strptime(query["X-Amz-Date"][0], "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+            return signed_at.timestamp() + int(query["X-Amz-Expires"][0])
+        except (KeyError, ValueError):
+            return None
+    if "Signature" in query:
+        try:
+            return float(query["Expires"][0])
+        except (KeyError, ValueError):
+            return None
+    return None
+
+
+def _resolve(presigned_url: str):
     """
-    Download a photo from a given AWS S3 presigned URL (provided in the request body)
-    and return it as a downloadable file.
+    Map the request onto (storage, key, upstream URL). Only presigned URLs
+    on the exact S3 endpoints of our own buckets are accepted, so the
+    endpoint can't be used as an open proxy. The signature stays the
+    caller's credential: the upstream URL is rebuilt from the validated
+    host with the caller's path and query, and S3 checks it.
     """
+    if presigned_url.startswith("http"):
+        for role in ("generated", "uploads"):
+            resolved = storage_key(presigned_url, role)
+            if resolved:
+                parts = urlsplit(presigned_url)
+                expires_at = _signature_expiry(parse_qs(parts.query))
+                if expires_at is None or expires_at <= time.time():
+                    raise HTTPException(status_code=403, detail="Download link is unsigned or has expired.")
+                upstream_url = urlunsplit(("https", parts.netloc.lower(), parts.path, parts.query, ""))
+                return get_storage(role), resolved, upstream_url
+    raise HTTPException(status_code=400, detail="URL does not point to a Coverly image.")
+
+
+async def _fetch(url: str, headers: dict) -> httpx.Response:
+    client = get_http_client()
     try:
-        response = requests.get(request.presigned_url, stream=True)
-        if response.status_code != 200:
-            raise HTTPException(status_code=400, detail="Failed to download file from presigned URL")
+        # S3 never redirects a valid GET; following one would leave the allowlisted host
+        upstream = await client.send(
+            client.build_request("GET", url, headers=headers), stream=True, follow_redirects=False
+        )
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=502, detail=f"Error fetching file: {str(e)}")
 
-        filename = "downloaded_photo"
-        content_disposition = response.headers.get("Content-Disposition")
-        if content_disposition and "filename=" in content_disposition:
-            filename = content_disposition.split("filename=")[-1].strip('"')
+    if upstream.status_code not in (200, 206, 304):
+        await upstream.aclose()
+        status_code = upstream.status_code if upstream.status_code in (403, 404) else 502
+        raise HTTPException(status_code=status_code, detail="Failed to download file")
+    return upstream
 
-        content_type = response.headers.get("Content-Type", "application/octet-stream")
 
-        return StreamingResponse(
-            BytesIO(response.content),
-            media_type=content_type,
-            headers={"Content-Disposition": f'attachment; filename="{filename}"'},
-        )
+async def _download(presigned_url, filename, mode, request: Request):
+    storage, object_key, upstream_url = _resolve(presigned_url)
+    filename = filename or PurePosixPath(object_key).name or "downloaded_photo"
+
+    # Zero-bandwidth mode: once S3 has accepted the caller's signature (a
+    # one-byte read), the browser fetches straight from S3 with the
+    # attachment disposition baked into a fresh short-lived signature
+    if mode == "redirect":
+        probe = await _fetch(upstream_url, {"range": "bytes=0-0"})
+        await probe.aclose()
+        url = storage.presign(object_key, DOWNLOAD_URL_TTL, filename=filename)
+        return RedirectResponse(url, status_code=303)
+
+    upstream_headers = {
+        name: request.headers[name]
+        for name in ("range", "if-none-match", "if-modified-since")
+        if name in request.headers
+    }
+    upstream = await _fetch(upstream_url, upstream_headers)
+
+    headers = {name: upstream.headers[name] for name in FORWARDED_HEADERS if name in upstream.headers}
+    headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+
+    # Chunks are pulled from S3 only as fast as the client drains them, so
+    # memory per download stays at one chunk regardless of image size
+    return StreamingResponse(
+        upstream.aiter_bytes(DOWNLOAD_CHUNK_SIZE),
+        status_code=upstream.status_code,
+        media_type=upstream.headers.get("content-type", "application/octet-stream"),
+        headers=headers,
+        background=BackgroundTask(upstream.aclose),
+    )
+
+
+@router.post("/download-photo/")
+async def download_photo(body: DownloadRequest, request: Request):
+    """
+    Download a photo, given a still-valid presigned URL from one of our
+    buckets. Streams the object through the API (honouring Range requests)
+    or, with mode="redirect", answers with a signed redirect.
+    """
+    return await _download(body.presigned_url, body.filename, body.mode, request)
+
 
-    except requests.exceptions.RequestException as e:
-        raise HTTPException(status_code=500, detail=f"Error fetching file: {str(e)}")
\ No newline at end of file
+@router.get("/download-photo/")
+async def download_photo_link(
+    request: Request,
+    url: str = Query(...),
+    filename: Optional[str] = Query(None),
+    mode: Literal["proxy", "redirect"] = Query("redirect"),
+):
+    """Link-friendly variant: defaults to a signed redirect so the API carries no bytes."""
+    return await _download(url, filename, mode, request)
@@ -0,0 +1,110 @@
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response, status
+from pydantic import BaseModel, Field
+from typing import List, Optional
+from datetime import datetime
+import base64
+import json
+import logging
+import uuid
+from ..db.repository import list_prompt_page
+from ..dependencies.auth import verify_supabase_token
+from ..services.history_cache import get_cached_page, store_page
+from ..services.url_signer import image_refs, sign_urls
+
+logger = logging.getLogger("coverly.api")
+router = APIRouter()
+
+
+class HistoryItem(BaseModel):
+    job_id: str
+    created_at: str
+    title: Optional[str] = None
+    user_query: Optional[str] = None
+    platform: Optional[str] = None
+    aspect_ratio: Optional[str] = None
+    status: Optional[str] = None
+    generated_images: List[str] = Field(default_factory=list, description="Freshly signed image URLs.")
+    generated_images_gemini: List[str] = Field(default_factory=list, description="Freshly signed image URLs.")
+
+
+class HistoryPage(BaseModel):
+    items: List[HistoryItem]
+    next_cursor: Optional[str] = Field(None, description="Pass as `cursor` to fetch the next page; null on the last page.")
+
+
+def encode_cursor(created_at: str, job_id: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([created_at, job_id]).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    # The values end up in a PostgREST filter, so only a real timestamp and
+    # UUID get through; anything else could rewrite the filter
+    try:
+        created_at, job_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return datetime.fromisoformat(created_at).isoformat(), str(uuid.UUID(job_id))
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor.")
+
+
+async def _sign_page(payload: dict) -> dict:
+    # Pages are cached with S3 keys; URLs are signed per response, the whole
+    # page in one batch, then sliced back onto each row
+    refs = [
+        (image_refs(row.get("generated_images")), image_refs(row.get("generated_images_gemini")))
+        for row in payload["items"]
+    ]
+    signed = await sign_urls(ref for openai_images, gemini_images in refs for ref in openai_images + gemini_images)
+    items = []
+    offset = 0
+    for row, (openai_images, gemini_images) in zip(payload["items"], refs):
+        middle = offset + len(openai_images)
+        end = middle + len(gemini_images)
+        items.append({
+            **row,
+            "generated_images": signed[offset:middle],
+            "generated_images_gemini": signed[middle:end],
+        })
+        offset = end
+    return {**payload, "items": items}
+
+
+@router.get(
+    "/my-thumbnails",
+    response_model=HistoryPage,
+    summary="Page through the caller's thumbnail history",
+)
+async def get_my_thumbnails(
+    response: Response,
+    cursor: Optional[str] = Query(None, description="Opaque cursor from the previous page."),
+    limit: int = Query(20, ge=1, le=100),
+    if_none_match: Optional[str] = Header(None),
+    user=Depends(verify_supabase_token),
+):
+    """
+    Newest-first history of the caller's jobs, `limit` rows at a time. Each
+    page carries an ETag; a matching If-None-Match gets an empty 304.
+    """
+    user_id = user["id"]
+    after = decode_cursor(cursor) if cursor else None
+    page = f"{cursor or ''}:{limit}"
+
+    cached = await get_cached_page(user_id, page)
+    if cached:
+        body, etag = cached
+        payload = json.loads(body)
+    else:
+        rows = await list_prompt_page(user_id, limit + 1, after)
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        payload = {
+            "items": rows,
+            "next_cursor": encode_cursor(rows[-1]["created_at"], rows[-1]["job_id"]) if has_more else None,
+        }
+        body, etag = await store_page(user_id, page, payload)
+
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    response.headers.update(headers)
+    return await _sign_page(payload)
@@ -1,9 +1,8 @@
-from fastapi import FastAPI, HTTPException, status
-from typing import List, Dict, Optional
+from fastapi import APIRouter, HTTPException, Query, status
+from typing import List
 from pydantic import BaseModel, Field
-from fastapi import APIRouter, HTTPException, status
-from typing import List, Optional
-from ..db.supabase_client import supabase
+from ..services.recent_images import recent_images, RECENT_IMAGES_MAX
+from ..services.url_signer import sign_urls
 import logging
 
 logger = logging.getLogger("coverly.api")
@@ -15,43 +14,19 @@ router = APIRouter()
 class ImageLinkResponse(BaseModel):
     """Defines the structure of the successful response."""
     user_id: str = Field(..., description="The UUID of the user queried.")
-    image_links: List[str] = Field(..., description="A list of unique image URLs.")
+    image_links: List[str] = Field(..., description="A list of unique, freshly signed image URLs.")
     count: int = Field(..., description="The number of unique image links returned.")
 
 
 # --- Core Logic Function (Modified for error handling) ---
-def fetch_latest_image_links(user_id: str, limit: int = 3) -> List[str]:
+async def fetch_latest_image_links(user_id: str, limit: int = 3) -> List[str]:
     """
-    Fetches the latest 'limit' rows for a user and extracts all image links.
-    (This is your original core logic, wrapped to raise exceptions.)
+    Image keys from the user's latest 'limit' generations, newest first and
+    without duplicates. Served from the per-user Redis list the worker keeps
+    up to date; the DB is only read for users not cached yet.
     """
     try:
-        response = supabase.table('thumbnail_prompts')\
-            .select('generated_images, generated_images_gemini')\
-            .eq('user_id', user_id)\
-            .order('created_at', desc=True)\
-            .limit(limit)\
-            .execute()
-
-        data = response.data
-        if not data:
-            return []
-
-        all_image_links: List[str] = []
-
-        for row in data:
-            for column_name in ['generated_images', 'generated_images_gemini']:
-                images_json: Optional[List[Dict]] = row.get(column_name)
-
-                if isinstance(images_json, list):
-                    for image_info in images_json:
-                        # Assumes 'url' key or direct string link, as per your original logic
-                        if isinstance(image_info, dict) and 'url' in image_info:
-                            all_image_links.append(image_info['url'])
-                        elif isinstance(image_info, str):
-                             all_image_links.append(image_info)
-
-        return list(set(all_image_links))
+        return await recent_images(user_id, limit)
 
     except Exception as e:
         # Raise a 500 Internal Server Error for database issues
@@ -70,16 +45,18 @@ def fetch_latest_image_links(user_id: str, limit: int = 3) -> List[str]:
 )
 async def get_latest_user_images(
     user_id: str, 
-    limit: int = 3 # Use query parameter for flexibility
+    limit: int = Query(3, ge=1, le=RECENT_IMAGES_MAX)
 ):
     """
-    Retrieves the unique image URLs generated across the user's latest N prompt jobs.
+    Retrieves the unique image URLs from the user's latest N generations, newest first.
     
     - **user_id**: The UUID of the user to query.
-    - **limit**: The number of latest jobs (rows) to check (default is 3).
+    - **limit**: The number of latest generations to include (default is 3).
     """
     
-    links = fetch_latest_image_links(user_id, limit)
+    links = await fetch_latest_image_links(user_id, limit)
+    # Rows store S3 keys (or legacy presigned URLs); sign fresh links on read
+    links = await sign_urls(links)
     
     if not links:
         # Return 404 if no data is found for the user/query
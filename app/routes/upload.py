@@ -1,8 +1,25 @@
-from fastapi import APIRouter, Form, File, UploadFile, HTTPException, status, Depends
+from fastapi import APIRouter, Form, File, UploadFile, HTTPException, status, Depends, Header
 from typing import List, Optional
 from ..db.queue_connection import enqueue_job
 from ..db.s3_storage import upload_to_s3
-from ..db.supabase_client import supabase
+from ..db.repository import insert_prompt
+from ..services.credit_ledger import consume_credit, refund_credit, get_credits
+from ..services.history_cache import invalidate_history
+from ..services.job_state import write_job_state
+from ..services.request_coalescing import (
+    request_fingerprint,
+    claim_idempotency_key,
+    bind_idempotency_key,
+    release_idempotency_key,
+    claim_leader,
+    release_leader,
+    add_follower,
+    fail_followers,
+    lookup_fingerprint,
+)
+from ..services.recent_images import push_recent_images
+from ..services.url_signer import sign_urls
+from ..utils.helper import publish_job_update
 from ..models.upload_prompt import UploadPromptRequest
 from ..dependencies.auth import verify_supabase_token
 import uuid
@@ -14,28 +31,73 @@ router = APIRouter()
 
 
 # ----------------------
-def initialize_user_credits(user_id: str):
-    """Ensure the user has a credits record; initialize with 5 if missing."""
-    res = supabase.table("user_credits").select("*").eq("user_id", user_id).execute()
-    if not res.data:
-        supabase.table("user_credits").insert({"user_id": user_id, "credits": 5}).execute()
+async def _duplicate_of(leader_job_id, user_id, user_query, image_urls, job_id, idempotency_key):
+    """Answer a repeat of the user's own request with the job already doing it."""
+    await refund_credit(user_id, job_id)
+    if idempotency_key:
+        await bind_idempotency_key(user_id, idempotency_key, leader_job_id)
+    logger.info(f"[Job Coalesced] duplicate of {leader_job_id} for user {user_id}")
+    return UploadPromptRequest(
+        user_query=user_query,
+        reference_images=image_urls,
+        remaining_credits=await get_credits(user_id),
+        job_id=leader_job_id,
+        user_id=user_id,
+        coalesced=True
+    )
+
+
+async def _abandon_upload(job_id, user_id, fingerprint, idempotency_key, inserted):
+    """Undo a failed upload: refund, free the fingerprint and fail anything already attached to it."""
+    await refund_credit(user_id, job_id)
+    if fingerprint:
+        await release_leader(fingerprint, job_id, user_id, completed=False)
+        # Other users can attach between the claim and the enqueue
+        await fail_followers(job_id)
+    if inserted:
+        await write_job_state(job_id, {"status": "failed"})
+        await invalidate_history(user_id)
+    if idempotency_key:
+        await release_idempotency_key(user_id, idempotency_key)
+
 
+async def _complete_from_cache(record: dict, cached_result: dict, image_urls, remaining_credits):
+    """Finalize a job whose exact request has been generated before."""
+    job_id, user_id = record["job_id"], record["user_id"]
+    images = {
+        column: cached_result.get(column) or []
+        for column in ("generated_images", "generated_images_gemini")
+    }
+    image_keys = images["generated_images"] + images["generated_images_gemini"]
 
-def get_user_credits(user_id: str) -> int:
-    res = supabase.table("user_credits").select("credits").eq("user_id", user_id).execute()
-    if res.data:
-        return res.data[0]["credits"]
-    return 0
+    inserted = await insert_prompt({
+        **record,
+        **images,
+        "title": cached_result.get("title"),
+        "refined_prompt": cached_result.get("refined_prompt"),
+        "status": "completed",
+    })
+    if not inserted:
+        logger.error(f"[Supabase Error] Failed to insert job {job_id}")
+        raise HTTPException(status_code=500, detail="Database insertion failed.")
 
+    signed_urls = await sign_urls(image_keys)
+    await asyncio.gather(
+        publish_job_update(job_id, "completed", progress=100, message="Thumbnail served from cache", generated_images=image_keys),
+        invalidate_history(user_id),
+        push_recent_images(user_id, image_keys),
+    )
+    logger.info(f"[Job Completed From Cache] {job_id} for user {user_id}")
 
-def consume_credit(user_id: str):
-    """Atomically decrement 1 credit."""
-    res = supabase.table("user_credits").select("credits").eq("user_id", user_id).execute()
-    if res.data and len(res.data) > 0:
-        current_credits = res.data[0]["credits"]
-        supabase.table("user_credits").update({
-            "credits": max(current_credits - 1, 0)
-        }).eq("user_id", user_id).execute()
+    return UploadPromptRequest(
+        user_query=record["user_query"],
+        reference_images=image_urls,
+        remaining_credits=remaining_credits,
+        job_id=job_id,
+        user_id=user_id,
+        status="completed",
+        generated_images=signed_urls
+    )
 
 
 # ----------------------
@@ -54,25 +116,42 @@ async def upload_prompt_with_images(
     platform: Optional[str] = Form("YouTube"),
     generator_provider: Optional[str] = Form("openai"),
     reference_images: Optional[UploadFile] = File(None),
+    idempotency_key: Optional[str] = Header(None),
 
     user=Depends(verify_supabase_token)  
 ):
     user_id = user['id']
     provider = user.get("app_metadata", {}).get("provider", "unknown")
-    initialize_user_credits(user_id)
-    remaining_credits = get_user_credits(user_id)
+    job_id = str(uuid.uuid4())
+
+    # A retried request with the same Idempotency-Key gets the original job
+    if idempotency_key:
+        existing_job_id = await claim_idempotency_key(user_id, idempotency_key, job_id)
+        if existing_job_id:
+            logger.info(f"[Idempotent Replay] {existing_job_id} for user {user_id}")
+            return UploadPromptRequest(
+                user_query=user_query,
+                remaining_credits=await get_credits(user_id),
+                job_id=existing_job_id,
+                user_id=user_id,
+                coalesced=True
+            )
+
+    remaining_credits = await consume_credit(user_id)
 
-    if remaining_credits <= 0:
+    if remaining_credits is None:
+        if idempotency_key:
+            await release_idempotency_key(user_id, idempotency_key)
         raise HTTPException(
             status_code=403,
             detail="You have exhausted your free credits."
         )
 
-    consume_credit(user_id)
-    remaining_credits -= 1
-
-    job_id = str(uuid.uuid4())
     image_urls: List[str] = []
+    image_keys: List[str] = []
+    image_hashes: List[str] = []
+    fingerprint: Optional[str] = None
+    inserted = None
 
     try:
         if reference_images:
@@ -88,8 +167,10 @@ async def upload_prompt_with_images(
                 
                 results = await asyncio.gather(*upload_tasks, return_exceptions=True)
                 
-                if results and not isinstance(results[0], Exception):
-                    image_urls.append(results[0])
+                if results and results[0] and not isinstance(results[0], Exception):
+                    image_urls.append(results[0]["url"])
+                    image_keys.append(results[0]["key"])
+                    image_hashes.append(results[0]["sha256"])
                 elif results and isinstance(results[0], Exception):
                     logger.error(f"[Upload Error] {reference_images.filename}: {results[0]}")
 
@@ -104,7 +185,8 @@ async def upload_prompt_with_images(
             "user_id": user_id,           
             "provider": provider,
             "user_query": user_query,
-            "reference_images": image_urls or [],
+            "reference_images": image_keys,
+            "reference_image_hashes": image_hashes,
             "aspect_ratio": aspect_ratio,    
             "platform": platform,   
             "generator_provider": generator_provider,
@@ -112,33 +194,63 @@ async def upload_prompt_with_images(
             "credits_consumed": 1
         }
 
-        response = supabase.table("thumbnail_prompts").insert(record).execute()
-        if not response.data:
+        claimed = request_fingerprint(user_query, platform, aspect_ratio, image_hashes, generator_provider)
+        leader, cached_result = await lookup_fingerprint(claimed)
+
+        # The user's own identical job is queued or just finished: hand it back
+        if leader and leader[1] == user_id:
+            return await _duplicate_of(leader[0], user_id, user_query, image_urls, job_id, idempotency_key)
+
+        # Already generated for this exact request: complete inline, no queue
+        if cached_result:
+            return await _complete_from_cache(record, cached_result, image_urls, remaining_credits)
+
+        # Identical work already queued or just finished? Attach to it instead
+        leader = await claim_leader(claimed, job_id, user_id)
+        fingerprint = None if leader else claimed
+        if leader and leader[1] == user_id:
+            return await _duplicate_of(leader[0], user_id, user_query, image_urls, job_id, idempotency_key)
+
+        inserted = await insert_prompt(record)
+        if not inserted:
             logger.error(f"[Supabase Error] Failed to insert job {job_id}")
             raise HTTPException(status_code=500, detail="Database insertion failed.")
+        await invalidate_history(user_id)
 
-        job_data = {
-            "job_id": job_id,
-            "type": "upload_prompt",
-            "reference_images": image_urls,
-            "user_prompt": user_query,
-            "user_id": user_id
-        }
-        await enqueue_job(job_data)
-        logger.info(f"[Job Enqueued] {job_id} for user {user_id}")
+        # Another user's identical job is in flight: this job gets its own
+        # record and follows the leader's event stream; the worker fills it in
+        coalesced = bool(leader) and await add_follower(leader[0], job_id, user_id)
+        if coalesced:
+            logger.info(f"[Job Coalesced] {job_id} follows {leader[0]} for user {user_id}")
+        else:
+            job_data = {
+                "job_id": job_id,
+                "type": "upload_prompt",
+                "reference_images": image_keys,
+                "reference_image_hashes": image_hashes,
+                "user_prompt": user_query,
+                "user_id": user_id,
+                # Only the leader releases the fingerprint when it finishes
+                "fingerprint": fingerprint
+            }
+            await enqueue_job(job_data)
+            logger.info(f"[Job Enqueued] {job_id} for user {user_id}")
 
         return UploadPromptRequest(
             user_query=user_query,
             reference_images=image_urls,
             remaining_credits=remaining_credits,
             job_id=job_id,
-            user_id=user_id
+            user_id=user_id,
+            coalesced=coalesced
         )
 
     except HTTPException:
+        await _abandon_upload(job_id, user_id, fingerprint, idempotency_key, inserted)
         raise
     except Exception as e:
         logger.exception(f"[Upload Prompt Error] Job {job_id} failed: {e}")
+        await _abandon_upload(job_id, user_id, fingerprint, idempotency_key, inserted)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Unexpected error while processing upload."
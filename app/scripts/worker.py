@@ -1,10 +1,11 @@
 import os
 import sys
-import json
 import asyncio
+import signal
 import logging
 import builtins
-from typing import TypedDict, List
+import time
+from typing import Annotated, Dict, TypedDict, List
 
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -12,19 +13,42 @@ root_dir = os.path.abspath(os.path.join(current_dir, "../.."))
 if root_dir not in sys.path:
     sys.path.append(root_dir)
 from dotenv import load_dotenv
-from langgraph.graph import StateGraph
+from langgraph.graph import StateGraph, END
 from langsmith import traceable, Client
 
-from app.db.queue_connection import redis_conn, dequeue_job
-from app.services.refine_prompts import refine_prompt, extract_title
+from app.db.queue_connection import (
+    redis_conn,
+    dequeue_job,
+    ack_job,
+    nack_job,
+    extend_lease,
+    reclaim_expired_jobs,
+    VISIBILITY_TIMEOUT,
+    MAX_ATTEMPTS,
+)
+from app.services.refine_prompts import refine_prompt_and_title
+from app.services.refine_cache import cached_refinement
 from app.services.youtube_service import fetch_top_videos
 from app.services.openai import thumbnail_generation
 from app.services.gemini_image_generation import thumbnail_generation_gemini
-from app.db.supabase_client import supabase
+from app.services.clients import close_clients
+from app.services.generation_cache import generate_once
+from app.services.url_signer import sign_urls
+from app.services.credit_ledger import refund_credit
+from app.services.history_cache import invalidate_history
+from app.services.recent_images import push_recent_images
+from app.services.request_coalescing import release_leader, take_followers, fail_followers, store_request_result
+from app.db.repository import get_prompt
+from app.services.job_state import (
+    write_job_state,
+    reset_job_state,
+    flush_all_job_states,
+    job_state_flush_loop,
+)
 from app.utils.helper import (
     upload_base64_to_s3,
-    generate_presigned_url,
     compute_cache_key,
+    reference_image_hashes,
     publish_job_update,
 )
 
@@ -59,31 +83,38 @@ client = Client()
 # ------------------------------------------------------------------
 # State Schema
 # ------------------------------------------------------------------
+# Parallel branches (e.g. generate_openai next to fetch_youtube) can write in
+# the same step, so shared keys need reducers instead of last-value channels.
+STATUS_PRECEDENCE = {"completed": 2, "failed": 1}
+
+def merge_status(current: str | None, update: str | None) -> str | None:
+    """A finished branch's status is never overwritten by an in-progress one."""
+    if current is None:
+        return update
+    if update is None:
+        return current
+    return update if STATUS_PRECEDENCE.get(update, 0) >= STATUS_PRECEDENCE.get(current, 0) else current
+
+def merge_dicts(current: dict | None, update: dict | None) -> dict:
+    return {**(current or {}), **(update or {})}
+
 class ThumbnailState(TypedDict, total=False):
     user_query: str
     job_id: str
+    user_id: str
     refined_prompt: str
     title: str
     reference_images: List[str]
+    reference_image_hashes: List[str]
     youtube_examples: List[dict]
     generated_images: List[str]
+    generated_images_gemini: List[str]
     aspect_ratio: str
     platform: str
-    status: str
+    status: Annotated[str, merge_status]
     generator_provider: str
-
-# ------------------------------------------------------------------
-# Supabase Helpers
-# ------------------------------------------------------------------
-async def db_update(table: str, data: dict, job_id: str):
-    return await asyncio.to_thread(
-        lambda: supabase.table(table).update(data).eq("job_id", job_id).execute()
-    )
-
-async def db_select(table: str, job_id: str):
-    return await asyncio.to_thread(
-        lambda: supabase.table(table).select("*").eq("job_id", job_id).execute()
-    )
+    node_status: Annotated[Dict[str, str], merge_dicts]
+    node_timings: Annotated[Dict[str, int], merge_dicts]
 
 # ------------------------------------------------------------------
 # LangGraph Nodes
@@ -93,26 +124,28 @@ async def refine_prompt_node(state: ThumbnailState) -> dict:
     job_id = state["job_id"]
     try:
         await publish_job_update(job_id, "refining_prompt", progress=10, message="Refining the input prompt...")
-        await db_update("thumbnail_prompts", {"status": "refining_prompt"}, job_id)
+        await write_job_state(job_id, {"status": "refining_prompt"})
+
+        aspect_ratio = state.get("aspect_ratio", "16:9")
+        platform = state.get("platform", "YouTube")
+
+        async def _refine():
+            return await refine_prompt_and_title(state["user_query"], aspect_ratio, platform, job_id)
 
-        refined_prompt = await refine_prompt(
-            state["user_query"],
-            aspect_ratio=state.get("aspect_ratio", "16:9"),
-            platform=state.get("platform", "YouTube")
-        )
-        title = await extract_title(refined_prompt, platform=state.get("platform", "YouTube"))
+        refinement = await cached_refinement(state["user_query"], platform, aspect_ratio, _refine)
+        refined_prompt, title = refinement["refined_prompt"], refinement["title"]
 
-        await db_update("thumbnail_prompts", {
+        await write_job_state(job_id, {
             "refined_prompt": refined_prompt,
             "title": title,
             "status": "refined"
-        }, job_id)
+        })
 
         return {"refined_prompt": refined_prompt, "title": title, "status": "refined"}
 
     except Exception as e:
         print(f"[Error] refine_prompt_node: {e}")
-        await db_update("thumbnail_prompts", {"status": "failed"}, job_id)
+        await write_job_state(job_id, {"status": "failed"})
         await publish_job_update(job_id, "refining_prompt", progress=10, message=f"failed to refine prompt - {e}")
 
         print(f"[Error] refine_prompt_node: {e}")
@@ -123,17 +156,17 @@ async def fetch_youtube_node(state: ThumbnailState) -> dict:
     job_id = state["job_id"]
     try:
         await publish_job_update(job_id, "fetching_youtube", progress=30, message="Fetching YouTube references...")
-        await db_update("thumbnail_prompts", {"status": "fetching_youtube"}, job_id)
+        await write_job_state(job_id, {"status": "fetching_youtube"})
 
         videos = await fetch_top_videos(state["title"])
-        await db_update("thumbnail_prompts", {
+        await write_job_state(job_id, {
             "youtube_examples": videos,
             "status": "videos_fetched"
-        }, job_id)
+        })
 
         return {"youtube_examples": videos, "status": "videos_fetched"}
     except Exception as e:
-        await db_update("thumbnail_prompts", {"status": "failed"}, job_id)
+        await write_job_state(job_id, {"status": "failed"})
         await publish_job_update(job_id, "fetching_youtube", progress=30, message=f"failed to fetch YouTube references - {e}")
         print(f"[Error] fetch_youtube_node: {e}")
         return {"status": "failed"}
@@ -143,22 +176,32 @@ async def generate_openai_node(state: ThumbnailState) -> dict:
     job_id = state["job_id"]
     prompt = state["refined_prompt"]
     ref_images = state.get("reference_images", [])
+    aspect_ratio = state.get("aspect_ratio", "16:9")
+    platform = state.get("platform", "YouTube")
     try:
         await publish_job_update(job_id, "generating_openai", progress=60, message="Generating thumbnail with OpenAI...")
-        image_base64 = await thumbnail_generation(prompt, ref_images, [], aspect_ratio=state.get("aspect_ratio", "16:9"),platform=state.get("platform", "YouTube"))
+        ref_hashes = reference_image_hashes(ref_images, state.get("reference_image_hashes"))
+        cache_key = compute_cache_key(prompt, ref_hashes, "openai", aspect_ratio=aspect_ratio, platform=platform)
 
-        signed_url, s3_key = upload_base64_to_s3(image_base64, job_id)
-        cache_key = await compute_cache_key(prompt, ref_images, "openai")
+        async def _generate():
+            image_base64 = await thumbnail_generation(prompt, ref_images, [], aspect_ratio=aspect_ratio,platform=platform,reference_hashes=ref_hashes)
+            if not image_base64:
+                raise RuntimeError("OpenAI returned no image")
+            s3_key = await upload_base64_to_s3(image_base64, job_id)
+            return [s3_key]
 
-        await redis_conn.setex(f"img_cache:{cache_key}", 7*24*3600, json.dumps({"s3_keys": [s3_key]}))
-        await publish_job_update(job_id, "completed", progress=100, message="Thumbnail generated via OpenAI", generated_images=[signed_url])
+        s3_keys, from_cache = await generate_once(cache_key, _generate)
+        if from_cache:
+            print(f"[Cache] OpenAI result reused for job {job_id}")
 
-        await db_update("thumbnail_prompts", {"generated_images": [signed_url], "status": "completed"}, job_id)
-        return {"generated_images": [signed_url], "status": "completed"}
+        await publish_job_update(job_id, "completed", progress=100, message="Thumbnail generated via OpenAI", generated_images=s3_keys)
+        await write_job_state(job_id, {"generated_images": s3_keys, "status": "completed"})
+        await push_recent_images(state.get("user_id"), s3_keys)
+        return {"generated_images": s3_keys, "status": "completed"}
 
     except Exception as e:
         print(f"[Error] generate_openai_node: {e}")
-        await db_update("thumbnail_prompts", {"status": "failed"}, job_id)
+        await write_job_state(job_id, {"status": "failed"})
         await publish_job_update(job_id, "generating_openai", progress=60, message=f"failed to generate thumbnail via OpenAI - {e}")
         return {"status": "failed"}
 
@@ -168,30 +211,31 @@ async def generate_gemini_node(state: ThumbnailState) -> dict:
     prompt = state["refined_prompt"]
     ref_images = state.get("reference_images", [])
     youtube_examples = state.get("youtube_examples", [])
+    aspect_ratio = state.get("aspect_ratio", "16:9")
+    platform = state.get("platform", "YouTube")
     try:
         await publish_job_update(job_id, "generating_gemini", progress=60, message="Generating thumbnail with Gemini...")
-        cache_key = await compute_cache_key(prompt, ref_images, "gemini")
+        ref_hashes = reference_image_hashes(ref_images, state.get("reference_image_hashes"))
+        cache_key = compute_cache_key(prompt, ref_hashes, "gemini", aspect_ratio=aspect_ratio, platform=platform, youtube_examples=youtube_examples)
 
-        cached = await redis_conn.get(f"img_cache:{cache_key}")
-        if cached:
-            cached_data = json.loads(cached)
-            s3_keys = cached_data["s3_keys"]
-            presigned_urls = [generate_presigned_url(k) for k in s3_keys]
-            await publish_job_update(job_id, "completed", progress=100, generated_images=presigned_urls)
-            await db_update("thumbnail_prompts", {"generated_images_gemini": presigned_urls, "status": "completed"}, job_id)
-            return {"generated_images_gemini": presigned_urls, "status": "completed"}
+        async def _generate():
+            result = await thumbnail_generation_gemini(prompt, ref_images, youtube_examples, job_id, aspect_ratio=aspect_ratio,platform=platform,reference_hashes=ref_hashes)
+            if not result["s3_keys"]:
+                raise RuntimeError("Gemini returned no image")
+            return result["s3_keys"]
 
-        result = await thumbnail_generation_gemini(prompt, ref_images, youtube_examples, job_id, aspect_ratio=state.get("aspect_ratio", "16:9"),platform=state.get("platform", "YouTube"))
-        image_urls = result["image_urls"]
+        s3_keys, from_cache = await generate_once(cache_key, _generate)
+        if from_cache:
+            print(f"[Cache] Gemini result reused for job {job_id}")
 
-        await redis_conn.setex(f"img_cache:{cache_key}", 7 * 24 * 3600, json.dumps({"s3_keys": image_urls}))
-        await publish_job_update(job_id, "completed", progress=100, generated_images=image_urls)
-        await db_update("thumbnail_prompts", {"generated_images_gemini": image_urls, "status": "completed"}, job_id)
+        await publish_job_update(job_id, "completed", progress=100, generated_images=s3_keys)
+        await write_job_state(job_id, {"generated_images_gemini": s3_keys, "status": "completed"})
+        await push_recent_images(state.get("user_id"), s3_keys)
 
-        return {"generated_images_gemini": image_urls, "status": "completed"}
+        return {"generated_images_gemini": s3_keys, "status": "completed"}
 
     except Exception as e:
-        await db_update("thumbnail_prompts", {"status": "failed"}, job_id)
+        await write_job_state(job_id, {"status": "failed"})
         await publish_job_update(job_id, "generating_gemini", progress=60, message=f"failed to generate thumbnail via Gemini - {e}")
         print(f"[Gemini Node Error] Job {job_id} failed: {e}")
         return {"status": "failed"}
@@ -199,76 +243,306 @@ async def generate_gemini_node(state: ThumbnailState) -> dict:
 # ------------------------------------------------------------------
 # LangGraph Definition
 # ------------------------------------------------------------------
+def timed_node(name: str, node):
+    """Wrap a node so its wall-clock time and outcome land in the state."""
+    async def _run(state: ThumbnailState) -> dict:
+        started = time.perf_counter()
+        result = await node(state)
+        elapsed_ms = round((time.perf_counter() - started) * 1000)
+        print(f"[Timing] Job {state['job_id']} {name}: {elapsed_ms} ms")
+        return {
+            **result,
+            "node_status": {name: result.get("status")},
+            "node_timings": {name: elapsed_ms},
+        }
+    return _run
+
+def _provider(state: ThumbnailState) -> str:
+    return (state.get("generator_provider") or "gemini").lower()
+
+def route_after_refine(state: ThumbnailState) -> List[str]:
+    """
+    OpenAI generation only needs the refined prompt, so it starts right away
+    and runs next to the YouTube lookup that feeds Gemini.
+    """
+    if state["node_status"].get("refine_prompt") == "failed":
+        return [END]
+    provider = _provider(state)
+    targets = []
+    if provider in ("openai", "both"):
+        targets.append("generate_openai")
+    if provider in ("gemini", "both"):
+        targets.append("fetch_youtube" if state.get("platform") == "YouTube" else "generate_gemini")
+    return targets or [END]
+
+def route_after_youtube(state: ThumbnailState) -> str:
+    if state["node_status"].get("fetch_youtube") == "failed":
+        return END
+    return "generate_gemini"
+
 graph = StateGraph(state_schema=ThumbnailState)
-graph.add_node("refine_prompt", refine_prompt_node)
-graph.add_node("fetch_youtube", fetch_youtube_node)
-graph.add_node("generate_openai", generate_openai_node)
-graph.add_node("generate_gemini", generate_gemini_node)
+graph.add_node("refine_prompt", timed_node("refine_prompt", refine_prompt_node))
+graph.add_node("fetch_youtube", timed_node("fetch_youtube", fetch_youtube_node))
+graph.add_node("generate_openai", timed_node("generate_openai", generate_openai_node))
+graph.add_node("generate_gemini", timed_node("generate_gemini", generate_gemini_node))
+
+graph.add_conditional_edges(
+    "refine_prompt",
+    route_after_refine,
+    ["generate_openai", "fetch_youtube", "generate_gemini", END],
+)
+graph.add_conditional_edges("fetch_youtube", route_after_youtube, ["generate_gemini", END])
+graph.add_edge("generate_openai", END)
+graph.add_edge("generate_gemini", END)
+graph.set_entry_point("refine_prompt")
+pipeline = graph.compile()
+
+# ------------------------------------------------------------------
+# Job Execution
+# ------------------------------------------------------------------
+async def process_job(job: dict):
+    """Run the full thumbnail pipeline for a single dequeued job."""
+    job_id = job.get("job_id")
+    user_id = job.get("user_id")
+    print(f"[Worker] Got job: {job_id} for user {user_id}")
+
+    record = await get_prompt(job_id)
+    if not record:
+        print(f"[Worker Error] No record found for job {job_id}")
+        await refund_credit(user_id, job_id)
+        await finish_coalesced(job, {"status": "failed"})
+        return
+    await reset_job_state(job_id)
+
+    state = {
+        "job_id": job_id,
+        "user_id": user_id,
+        "user_query": record.get("user_query", ""),
+        # Records hold S3 keys; sign them here so providers can download the images
+        "reference_images": await sign_urls(record.get("reference_images") or [], "uploads"),
+        "reference_image_hashes": record.get("reference_image_hashes") or [],
+        "youtube_examples": record.get("youtube_examples", []),
+        "platform": record.get("platform", "YouTube"),
+        "aspect_ratio": record.get("aspect_ratio", "16:9"),
+        "generator_provider": record.get("generator_provider", "gemini"),
+    }
+
+    # --- Execute pipeline ---
+    started = time.perf_counter()
+    final_state = await pipeline.ainvoke(state)
+    timings = {
+        **final_state.get("node_timings", {}),
+        "total": round((time.perf_counter() - started) * 1000),
+    }
+    print(f"[Worker] Job {job_id} finished with status={final_state.get('status')} timings={timings}")
+    await write_job_state(job_id, {"node_timings": timings})
+    await invalidate_history(user_id)
+    if final_state.get("status") == "failed":
+        await refund_credit(user_id, job_id)
+    await finish_coalesced(job, final_state)
+
+
+async def finish_coalesced(job: dict, final_state: dict):
+    """
+    Release the job's request fingerprint and hand its outcome to the jobs
+    of other users that were coalesced onto it at upload.
+    """
+    job_id = job.get("job_id")
+    completed = final_state.get("status") == "completed"
+    await release_leader(job.get("fingerprint"), job_id, job.get("user_id"), completed)
+    if not completed:
+        await fail_followers(job_id)
+        return
+
+    images = {
+        column: final_state[column]
+        for column in ("generated_images", "generated_images_gemini")
+        if final_state.get(column)
+    }
+    node_status = final_state.get("node_status") or {}
+    provider = _provider(final_state)
+    requested = [f"generate_{name}" for name in ("openai", "gemini") if provider in (name, "both")]
+    # With generator "both" the job completes when either provider does; a
+    # partial result must not stand in for identical requests
+    if images and requested and all(node_status.get(node) == "completed" for node in requested):
+        # Lets upload answer the next identical request without queueing it
+        await store_request_result(job.get("fingerprint"), {
+            **images,
+            "title": final_state.get("title"),
+            "refined_prompt": final_state.get("refined_prompt"),
+        })
+    for follower in await take_followers(job_id):
+        follower_job, follower_user = follower["job_id"], follower["user_id"]
+        await write_job_state(follower_job, {
+            **images,
+            "title": final_state.get("title"),
+            "refined_prompt": final_state.get("refined_prompt"),
+            "status": "completed",
+        })
+        await invalidate_history(follower_user)
+        await push_recent_images(follower_user, [key for keys in images.values() for key in keys])
+        print(f"[Worker] Job {follower_job} finished with leader {job_id}")
+
+
+async def run_job(job: dict, receipt: str):
+    """
+    Task wrapper around `process_job`: isolates failures to the job itself,
+    keeps the queue lease alive while it runs, and acks the job once it has
+    reached a terminal state. Jobs interrupted by shutdown are nacked so
+    another worker picks them up straight away.
+    """
+    job_id = job.get("job_id")
+    heartbeat = asyncio.create_task(_keep_lease_alive(receipt))
+    try:
+        await process_job(job)
+    except asyncio.CancelledError:
+        print(f"[Worker] Job {job_id} interrupted by shutdown, re-queueing", level="warning")
+        await asyncio.shield(_requeue_interrupted(job_id, receipt))
+        raise
+    except Exception as e:
+        print(f"[Worker Error] Job {job_id} failed: {e}", level="error")
+        await write_job_state(job_id, {"status": "failed"})
+        await invalidate_history(job.get("user_id"))
+        await refund_credit(job.get("user_id"), job_id)
+        await finish_coalesced(job, {"status": "failed"})
+    finally:
+        heartbeat.cancel()
 
-def decide_next(state):
-    return "fetch_youtube" if state.get("platform") == "YouTube" else "generate_openai"
+    if not await ack_job(receipt):
+        print(f"[Worker] Lease on job {job_id} was reclaimed before it finished; it has been redelivered", level="warning")
+
+
+async def _keep_lease_alive(receipt: str):
+    while True:
+        await asyncio.sleep(VISIBILITY_TIMEOUT / 3)
+        try:
+            if not await extend_lease(receipt):
+                # Reclaimed and redelivered; that delivery owns the job now
+                print(f"[Worker] Lease {receipt} lost, no longer extending it", level="warning")
+                return
+        except Exception as e:
+            print(f"[Worker Error] Lease extension failed: {e}", level="warning")
+
+
+async def _requeue_interrupted(job_id: str, receipt: str):
+    try:
+        # If the lease was already reclaimed, another delivery owns the job's state
+        if not await extend_lease(receipt):
+            return
+        await write_job_state(job_id, {"status": "queued"}, force=True, flush=True)
+        await nack_job(receipt)
+    except Exception as e:
+        print(f"[Worker Error] Could not re-queue job {job_id}: {e}", level="error")
+
+
+async def reclaim_loop(stop_event: asyncio.Event):
+    """Periodically return jobs abandoned by crashed workers to the queue."""
+    while not stop_event.is_set():
+        try:
+            requeued, dead = await reclaim_expired_jobs()
+            if requeued:
+                print(f"[Worker] Reclaimed {requeued} expired job(s)")
+            for job in dead:
+                print(f"[Worker] Job {job.get('job_id')} dead-lettered after {MAX_ATTEMPTS} attempts", level="error")
+                await write_job_state(job["job_id"], {"status": "failed"})
+                await invalidate_history(job.get("user_id"))
+                await refund_credit(job.get("user_id"), job["job_id"])
+                await finish_coalesced(job, {"status": "failed"})
+        except Exception as e:
+            print(f"[Worker Error] Reclaim failed: {e}", level="error")
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=RECLAIM_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
 
-graph.add_conditional_edges("refine_prompt", decide_next, {"fetch_youtube": "fetch_youtube", "generate_openai": "generate_openai"})
-graph.add_edge("fetch_youtube", "generate_openai")
-graph.add_edge("fetch_youtube", "generate_gemini")
-graph.set_entry_point("refine_prompt")
-graph.compile()
 
 # ------------------------------------------------------------------
 # Worker Loop
 # ------------------------------------------------------------------
-async def worker_loop():
-    print("[Worker] Started. Waiting for jobs...")
+WORKER_CONCURRENCY = max(1, int(os.getenv("WORKER_CONCURRENCY", "4")))
+WORKER_SHUTDOWN_GRACE = float(os.getenv("WORKER_SHUTDOWN_GRACE", "30"))
+RECLAIM_INTERVAL = float(os.getenv("QUEUE_RECLAIM_INTERVAL", "30"))
+
+
+async def worker_loop(stop_event: asyncio.Event | None = None):
+    """
+    Keep up to WORKER_CONCURRENCY jobs in flight. A slot is reserved before a
+    job is dequeued, so the worker never takes work it cannot start. On stop,
+    in-flight jobs get WORKER_SHUTDOWN_GRACE seconds to finish before they are
+    cancelled and re-queued.
+    """
+    stop_event = stop_event or asyncio.Event()
+    slots = asyncio.Semaphore(WORKER_CONCURRENCY)
+    in_flight: set[asyncio.Task] = set()
+
+    print(f"[Worker] Started with concurrency={WORKER_CONCURRENCY}. Waiting for jobs...")
     try:
         await redis_conn.ping()
         print("[Worker] Connected to Redis ✅")
     except Exception as e:
         print(f"[Worker] Redis connection failed: {e}")
 
-    while True:
-        job = await dequeue_job()
-        if not job:
-            await asyncio.sleep(1)
-            continue
+    def _release(task: asyncio.Task):
+        in_flight.discard(task)
+        slots.release()
+
+    reclaimer = asyncio.create_task(reclaim_loop(stop_event))
+    state_flusher = asyncio.create_task(job_state_flush_loop(stop_event))
+    try:
+        while not stop_event.is_set():
+            await slots.acquire()
+            try:
+                # Blocks on the server until a job arrives, so idle workers wake instantly
+                leased = await dequeue_job()
+            except Exception as e:
+                slots.release()
+                print(f"[Worker Error] Dequeue failed: {e}", level="error")
+                await asyncio.sleep(1)
+                continue
 
-        job_id = job.get("job_id")
-        user_id = job.get("user_id")
-        print(f"[Worker] Got job: {job_id} for user {user_id}")
+            if not leased:
+                slots.release()
+                continue
 
+            job, receipt = leased
+            task = asyncio.create_task(run_job(job, receipt), name=f"job:{job.get('job_id')}")
+            in_flight.add(task)
+            task.add_done_callback(_release)
+    finally:
+        reclaimer.cancel()
+        if in_flight:
+            print(f"[Worker] Draining {len(in_flight)} in-flight job(s)...")
+            _, pending = await asyncio.wait(in_flight, timeout=WORKER_SHUTDOWN_GRACE)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        state_flusher.cancel()
+        await flush_all_job_states()
+        print("[Worker] Stopped.")
+
+
+async def main():
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
         try:
-            record_res = await db_select("thumbnail_prompts", job_id)
-            if not record_res.data:
-                print(f"[Worker Error] No record found for job {job_id}")
-                continue
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass  # e.g. Windows: fall back to KeyboardInterrupt
 
-            record = record_res.data[0]
-            state = {
-                "job_id": job_id,
-                "user_id": user_id,
-                "user_query": record.get("user_query", ""),
-                "reference_images": record.get("reference_images", []),
-                "youtube_examples": record.get("youtube_examples", []),
-                "platform": record.get("platform", "YouTube"),
-                "aspect_ratio": record.get("aspect_ratio", "16:9"),
-                "generator_provider": record.get("generator_provider", "gemini"),
-            }
-
-            # --- Execute pipeline ---
-            state.update(await refine_prompt_node(state))
-            if state.get("platform") == "YouTube":
-                state.update(await fetch_youtube_node(state))
-
-            provider = record.get("generator_provider", "gemini").lower()
-            if provider == "openai":
-                await generate_openai_node(state)
-            elif provider == "gemini":
-                await generate_gemini_node(state)
-            elif provider == "both":
-                await asyncio.gather(generate_openai_node(state), generate_gemini_node(state))
+    loop_task = asyncio.create_task(worker_loop(stop_event))
+    stop_task = asyncio.create_task(stop_event.wait())
+    await asyncio.wait({loop_task, stop_task}, return_when=asyncio.FIRST_COMPLETED)
+
+    # worker_loop may be parked on a blocking dequeue; cancelling it runs its drain logic.
+    # A job moved mid-cancel stays in the processing list and is reclaimed later.
+    if not loop_task.done():
+        loop_task.cancel()
+    await asyncio.gather(loop_task, return_exceptions=True)
+    stop_task.cancel()
+    await close_clients()
 
-        except Exception as e:
-            print(f"[Worker Error] Job {job_id} failed: {e}")
-            await db_update("thumbnail_prompts", {"status": "failed"}, job_id)
 
 if __name__ == "__main__":
-    asyncio.run(worker_loop())
+    asyncio.run(main())
@@ -0,0 +1,68 @@
+import os
+import httpx
+from openai import AsyncOpenAI
+from google import genai
+from dotenv import load_dotenv
+from app.db.repository import close_db
+
+load_dotenv()
+
+# Shared, long-lived provider clients. Creating them once per process keeps
+# TCP/TLS connections pooled across jobs instead of re-handshaking per call.
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "120"))
+
+_http_client: httpx.AsyncClient | None = None
+_openai_client: AsyncOpenAI | None = None
+_gemini_client: genai.Client | None = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Pooled HTTP client for plain REST calls and image downloads."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(HTTP_TIMEOUT, connect=10.0),
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            ),
+            follow_redirects=True,
+        )
+    return _http_client
+
+
+def get_openai_client() -> AsyncOpenAI:
+    global _openai_client
+    if _openai_client is None:
+        _openai_client = AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            http_client=get_http_client(),
+        )
+    return _openai_client
+
+
+def get_gemini_client() -> genai.Client:
+    """Gemini client; use `.aio` on it for non-blocking calls."""
+    global _gemini_client
+    if _gemini_client is None:
+        _gemini_client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+    return _gemini_client
+
+
+async def close_clients():
+    """Release pooled connections on shutdown."""
+    global _http_client, _openai_client, _gemini_client
+    if _openai_client is not None:
+        await _openai_client.close()
+        _openai_client = None
+    if _gemini_client is not None:
+        aclose = getattr(_gemini_client.aio, "aclose", None)
+        if aclose:
+            await aclose()
+        _gemini_client = None
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+    await close_db()
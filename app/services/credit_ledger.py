@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import os
+from typing import Optional
+from dotenv import load_dotenv
+from app.db.queue_connection import redis_conn
+from app.db.repository import get_credit_balance, create_credit_balance, save_credit_balances
+
+load_dotenv()
+logger = logging.getLogger("coverly.credits")
+
+# Redis is the source of truth for balances while the app runs. A balance is
+# seeded from Supabase the first time a user is seen, every change marks the
+# user dirty, and a background flusher writes dirty balances back in batches.
+INITIAL_CREDITS = int(os.getenv("INITIAL_CREDITS", "5"))
+FLUSH_INTERVAL = float(os.getenv("CREDIT_FLUSH_INTERVAL", "5"))
+FLUSH_BATCH_SIZE = int(os.getenv("CREDIT_FLUSH_BATCH_SIZE", "500"))
+REFUND_MARKER_TTL = int(os.getenv("CREDIT_REFUND_MARKER_TTL", str(7 * 24 * 3600)))
+
+BALANCE_PREFIX = "credits"
+REFUND_PREFIX = "credits:refunded"
+DIRTY_KEY = "credits:dirty"
+
+NOT_SEEDED = -2
+EXHAUSTED = -1
+
+# KEYS: balance, dirty set | ARGV: user_id
+# Returns the new balance, EXHAUSTED, or NOT_SEEDED
+_CONSUME_SCRIPT = """
+local balance = redis.call('GET', KEYS[1])
+if not balance then
+    return -2
+end
+if tonumber(balance) <= 0 then
+    return -1
+end
+local remaining = redis.call('DECR', KEYS[1])
+redis.call('SADD', KEYS[2], ARGV[1])
+return remaining
+"""
+
+# KEYS: balance, dirty set, refund marker | ARGV: user_id, marker ttl
+# Returns 1 if refunded, 0 if this job was already refunded, or NOT_SEEDED
+_REFUND_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -2
+end
+if not redis.call('SET', KEYS[3], 1, 'NX', 'EX', tonumber(ARGV[2])) then
+    return 0
+end
+redis.call('INCR', KEYS[1])
+redis.call('SADD', KEYS[2], ARGV[1])
+return 1
+"""
+
+_consume = redis_conn.register_script(_CONSUME_SCRIPT)
+_refund = redis_conn.register_script(_REFUND_SCRIPT)
+
+
+def _balance_key(user_id: str) -> str:
+    return f"{BALANCE_PREFIX}:{user_id}"
+
+
+async def _seed(user_id: str):
+    balance = await get_credit_balance(user_id)
+    if balance is None:
+        balance = INITIAL_CREDITS
+        await create_credit_balance(user_id, balance)
+    # NX: a concurrent request may have seeded (and spent) already
+    await redis_conn.set(_balance_key(user_id), balance, nx=True)
+
+
+async def consume_credit(user_id: str) -> Optional[int]:
+    """
+    Atomically spend one credit. Returns the remaining balance, or None if
+    the user has none left. One Redis round trip once the user is seeded.
+    """
+    keys = [_balance_key(user_id), DIRTY_KEY]
+    remaining = await _consume(keys=keys, args=[user_id])
+    if remaining == NOT_SEEDED:
+        await _seed(user_id)
+        remaining = await _consume(keys=keys, args=[user_id])
+    if remaining == EXHAUSTED:
+        return None
+    return int(remaining)
+
+
+async def refund_credit(user_id: str, job_id: str) -> bool:
+    """Give back the credit spent on `job_id`. Safe to call more than once per job."""
+    if not user_id or not job_id:
+        return False
+    keys = [_balance_key(user_id), DIRTY_KEY, f"{REFUND_PREFIX}:{job_id}"]
+    args = [user_id, REFUND_MARKER_TTL]
+    refunded = await _refund(keys=keys, args=args)
+    if refunded == NOT_SEEDED:
+        await _seed(user_id)
+        refunded = await _refund(keys=keys, args=args)
+    if refunded == 1:
+        logger.info(f"Refunded 1 credit to {user_id} for job {job_id}")
+    return refunded == 1
+
+
+async def get_credits(user_id: str) -> int:
+    balance = await redis_conn.get(_balance_key(user_id))
+    if balance is None:
+        await _seed(user_id)
+        balance = await redis_conn.get(_balance_key(user_id))
+    return int(balance or 0)
+
+
+# ----------------------
+# Write-behind
+# ----------------------
+async def flush_credits() -> int:
+    """
+    Persist dirty balances to Supabase in one upsert. Users changed while a
+    flush is in progress are re-marked dirty by the scripts above, so they
+    are simply picked up by the next flush.
+    """
+    user_ids = await redis_conn.spop(DIRTY_KEY, FLUSH_BATCH_SIZE)
+    if not user_ids:
+        return 0
+
+    balances = await redis_conn.mget([_balance_key(u) for u in user_ids])
+    rows = [
+        {"user_id": user_id, "credits": int(balance)}
+        for user_id, balance in zip(user_ids, balances)
+        if balance is not None
+    ]
+    try:
+        if rows:
+            await save_credit_balances(rows)
+    except Exception:
+        await redis_conn.sadd(DIRTY_KEY, *user_ids)
+        raise
+    return len(rows)
+
+
+async def credit_flush_loop(stop_event: asyncio.Event | None = None):
+    stop_event = stop_event or asyncio.Event()
+    while not stop_event.is_set():
+        try:
+            # Drain in batches so a backlog doesn't wait a full interval per batch
+            while await flush_credits() >= FLUSH_BATCH_SIZE:
+                pass
+        except Exception as e:
+            logger.error(f"Credit flush failed: {e}")
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
@@ -1,14 +1,3 @@
-import base64
-import io
-import requests
-import os
-import asyncio
-import httpx
-from PIL import Image
-from io import BytesIO
-from io import BytesIO
-from PIL import Image
-from google import genai
 from google.genai import types
 
 
@@ -16,58 +5,33 @@ from google.genai import types
 from dotenv import load_dotenv
 from ..utils.helper import upload_to_s3_bytes
 from ..utils.system_prompts import build_thumbnail_system_prompt_gemini
+from .clients import get_gemini_client
+from .image_prep import prepare_images
 load_dotenv()
 
 
-client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
 
-
-
-async def fetch_image(url: str) -> Image.Image:
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(url)
-        resp.raise_for_status()
-        return Image.open(BytesIO(resp.content))
-
-async def fetch_all_images(urls: list) -> list:
-    tasks = [fetch_image(url) for url in urls]
-    return await asyncio.gather(*tasks)
-
-
-
-def pil_to_inline_data(image: Image.Image, mime_type="image/jpeg"):
-    """
-    Convert a PIL Image into Gemini-compatible inline_data.
-    """
-    buffer = io.BytesIO()
-    image.save(buffer, format="JPEG", quality=90)
-    return {
-        "mime_type": mime_type,
-        "data": buffer.getvalue()
-    }
-
-async def thumbnail_generation_gemini(refined_prompt: str, reference_image_urls: list, youtube_image_urls: list,job_id: str,aspect_ratio=str,platform=str):
+async def thumbnail_generation_gemini(refined_prompt: str, reference_image_urls: list, youtube_image_urls: list,job_id: str,aspect_ratio=str,platform=str,reference_hashes=None):
     prompt_text = build_thumbnail_system_prompt_gemini(refined_prompt,aspect_ratio,platform)
 
-    
+
     if not isinstance(youtube_image_urls, list):
         youtube_image_urls = [youtube_image_urls]
 
-    all_urls = reference_image_urls + [
+    youtube_urls = [
         item["thumbnail_url"] if isinstance(item, dict) else item
         for item in youtube_image_urls
     ]
-    all_urls = [url for url in all_urls if url]
+    all_urls = list(reference_image_urls) + youtube_urls
+    hashes = list(reference_hashes or [None] * len(reference_image_urls)) + [None] * len(youtube_urls)
+    pairs = [(url, h) for url, h in zip(all_urls, hashes) if url]
 
-    images = await fetch_all_images(all_urls)
-    
-    presenter_image = images[0]
-    ref_image1 = images[1] if len(images) > 1 else presenter_image
+    images = await prepare_images([u for u, _ in pairs], "gemini", [h for _, h in pairs])
 
-    presenter_inline = pil_to_inline_data(presenter_image)
-    ref1_inline = pil_to_inline_data(ref_image1)
-    if presenter_inline:
-        response = client.models.generate_content(
+    if images:
+        presenter_inline = {"mime_type": "image/jpeg", "data": images[0]}
+        ref1_inline = {"mime_type": "image/jpeg", "data": images[1] if len(images) > 1 else images[0]}
+        response = await get_gemini_client().aio.models.generate_content(
                 model="gemini-2.5-flash-image",
                 contents=[
                     {
@@ -75,7 +39,7 @@ async def thumbnail_generation_gemini(refined_prompt: str, reference_image_urls:
                         "parts": [
                             {"text": prompt_text + refined_prompt + """
                                 Interpret the images as follows:
-                                - Image 1: Presenter’s face — must stay identical. 
+                                - Image 1: Presenter’s face — must stay identical.
                                 - Images 2+: Reference layout/style only.
                             """},
                             {"inline_data": presenter_inline},
@@ -90,7 +54,7 @@ async def thumbnail_generation_gemini(refined_prompt: str, reference_image_urls:
     )
             )
     else:
-        response = client.models.generate_content(
+        response = await get_gemini_client().aio.models.generate_content(
                 model="gemini-2.5-flash-image",
                 contents=[
                     {
@@ -103,12 +67,12 @@ async def thumbnail_generation_gemini(refined_prompt: str, reference_image_urls:
                 ]
             )
 
-    output_urls = []
+    s3_keys = []
     count = 1
     for part in response.candidates[0].content.parts:
         if hasattr(part, "inline_data") and part.inline_data:
             img_bytes = part.inline_data.data
-            url = await upload_to_s3_bytes(img_bytes, job_id, count)
-            output_urls.append(url)
+            key = await upload_to_s3_bytes(img_bytes, job_id, count)
+            s3_keys.append(key)
             count += 1
-    return {"image_urls": output_urls}
+    return {"s3_keys": s3_keys}
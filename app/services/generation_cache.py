@@ -0,0 +1,123 @@
+import asyncio
+import json
+import os
+import uuid
+from typing import Awaitable, Callable, List, Tuple
+from dotenv import load_dotenv
+from app.db.queue_connection import redis_conn
+
+load_dotenv()
+
+# Result cache shared by every provider: cache key -> S3 object keys.
+# Only keys are stored; URLs are signed when a result is read.
+CACHE_PREFIX = "img_cache"
+LOCK_PREFIX = "img_cache_lock"
+CACHE_TTL = int(os.getenv("GENERATION_CACHE_TTL", str(7 * 24 * 3600)))
+LOCK_TTL = int(os.getenv("GENERATION_LOCK_TTL", "120"))
+WAIT_TIMEOUT = float(os.getenv("GENERATION_WAIT_TIMEOUT", "300"))
+POLL_INTERVAL = 0.5
+
+# Delete the lock only if we still own it
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+_release_lock = redis_conn.register_script(_RELEASE_SCRIPT)
+
+# Misses for the same key within this process share one future
+_inflight: dict[str, asyncio.Future] = {}
+
+
+async def get_cached_result(cache_key: str) -> List[str] | None:
+    """Return cached S3 keys for `cache_key`, or None on a miss."""
+    cached = await redis_conn.get(f"{CACHE_PREFIX}:{cache_key}")
+    if not cached:
+        return None
+    s3_keys = json.loads(cached).get("s3_keys") or []
+    # Older entries stored presigned URLs, which cannot be re-signed: treat as a miss
+    if not s3_keys or any(k.startswith("http") for k in s3_keys):
+        return None
+    return s3_keys
+
+
+async def store_result(cache_key: str, s3_keys: List[str]):
+    await redis_conn.setex(f"{CACHE_PREFIX}:{cache_key}", CACHE_TTL, json.dumps({"s3_keys": s3_keys}))
+
+
+async def generate_once(
+    cache_key: str,
+    produce: Callable[[], Awaitable[List[str]]],
+) -> Tuple[List[str], bool]:
+    """
+    Return `(s3_keys, from_cache)` for `cache_key`, calling `produce` only
+    when no worker anywhere has the result yet.
+
+    Concurrent misses are coalesced: within a process they await the same
+    future, and across processes a Redis lock elects one leader while the
+    others wait for the cache entry to appear.
+    """
+    s3_keys = await get_cached_result(cache_key)
+    if s3_keys:
+        return s3_keys, True
+
+    if cache_key in _inflight:
+        return await asyncio.shield(_inflight[cache_key]), True
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[cache_key] = future
+    try:
+        s3_keys, from_cache = await _generate_or_wait(cache_key, produce)
+        future.set_result(s3_keys)
+        return s3_keys, from_cache
+    except BaseException as e:
+        future.set_exception(e if isinstance(e, Exception) else RuntimeError("generation cancelled"))
+        future.exception()  # mark retrieved when nobody else is waiting
+        raise
+    finally:
+        _inflight.pop(cache_key, None)
+
+
+async def _generate_or_wait(cache_key, produce) -> Tuple[List[str], bool]:
+    lock_key = f"{LOCK_PREFIX}:{cache_key}"
+    token = uuid.uuid4().hex
+    deadline = asyncio.get_running_loop().time() + WAIT_TIMEOUT
+
+    while True:
+        if await redis_conn.set(lock_key, token, nx=True, ex=LOCK_TTL):
+            break
+
+        # Another worker is generating this result; wait for it to land
+        await asyncio.sleep(POLL_INTERVAL)
+        s3_keys = await get_cached_result(cache_key)
+        if s3_keys:
+            return s3_keys, True
+        if asyncio.get_running_loop().time() > deadline:
+            print(f"[Cache] Timed out waiting for {cache_key[:12]}, generating directly")
+            return await produce(), False
+
+    # Re-check: the previous leader may have finished between our GET and SET
+    s3_keys = await get_cached_result(cache_key)
+    if s3_keys:
+        await _release_lock(keys=[lock_key], args=[token])
+        return s3_keys, True
+
+    refresher = asyncio.create_task(_hold_lock(lock_key, token))
+    try:
+        s3_keys = await produce()
+        if s3_keys:
+            await store_result(cache_key, s3_keys)
+        return s3_keys, False
+    finally:
+        refresher.cancel()
+        await _release_lock(keys=[lock_key], args=[token])
+
+
+async def _hold_lock(lock_key: str, token: str):
+    """Keep the lock alive for generations that outlast LOCK_TTL."""
+    while True:
+        await asyncio.sleep(LOCK_TTL / 3)
+        if await redis_conn.get(lock_key) != token:
+            return
+        await redis_conn.expire(lock_key, LOCK_TTL)
@@ -0,0 +1,50 @@
+import hashlib
+import json
+import os
+import time
+from typing import Optional, Tuple
+from dotenv import load_dotenv
+from app.db.queue_connection import redis_conn
+from app.services.url_signer import REFRESH_MARGIN
+
+load_dotenv()
+
+# Rendered history pages per user, one hash per user keyed by page
+# (cursor + limit). A job being created or reaching a terminal state drops
+# the user's whole hash; the TTL bounds staleness for in-between statuses.
+HISTORY_CACHE_PREFIX = "history"
+HISTORY_CACHE_TTL = int(os.getenv("HISTORY_CACHE_TTL", "300"))
+
+
+def _key(user_id: str) -> str:
+    return f"{HISTORY_CACHE_PREFIX}:{user_id}"
+
+
+def page_etag(body: str) -> str:
+    # Bodies hold S3 keys and are signed per response. A signed URL is served
+    # with at least REFRESH_MARGIN of life left, so the tag rolls over every
+    # REFRESH_MARGIN and a revalidating client never keeps a link past expiry.
+    window = int(time.time() // REFRESH_MARGIN)
+    return '"' + hashlib.sha256(f"{window}:{body}".encode()).hexdigest()[:32] + '"'
+
+
+async def get_cached_page(user_id: str, page: str) -> Optional[Tuple[str, str]]:
+    """(body, etag) for a cached page, or None."""
+    body = await redis_conn.hget(_key(user_id), page)
+    if body is None:
+        return None
+    return body, page_etag(body)
+
+
+async def store_page(user_id: str, page: str, payload: dict) -> Tuple[str, str]:
+    body = json.dumps(payload, separators=(",", ":"), sort_keys=True)
+    async with redis_conn.pipeline(transaction=False) as pipe:
+        pipe.hset(_key(user_id), page, body)
+        pipe.expire(_key(user_id), HISTORY_CACHE_TTL)
+        await pipe.execute()
+    return body, page_etag(body)
+
+
+async def invalidate_history(user_id: Optional[str]):
+    if user_id:
+        await redis_conn.delete(_key(user_id))
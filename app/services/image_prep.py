@@ -0,0 +1,81 @@
+import asyncio
+import base64
+import hashlib
+import io
+import os
+from typing import List, Optional
+from cachetools import LRUCache
+from PIL import Image
+from dotenv import load_dotenv
+from app.db.queue_connection import redis_conn
+from .clients import get_http_client
+
+load_dotenv()
+
+# Longest side each model actually looks at. Anything larger is downscaled
+# by the provider anyway, so sending it only costs bandwidth and tokens.
+TARGET_MAX_SIDE = {
+    "gemini": int(os.getenv("GEMINI_REFERENCE_MAX_SIDE", "1024")),
+    "openai": int(os.getenv("OPENAI_REFERENCE_MAX_SIDE", "1024")),
+}
+JPEG_QUALITY = int(os.getenv("REFERENCE_JPEG_QUALITY", "85"))
+PREP_CACHE_PREFIX = "img_prep"
+PREP_CACHE_TTL = int(os.getenv("IMAGE_PREP_CACHE_TTL", str(7 * 24 * 3600)))
+
+_local_cache: LRUCache = LRUCache(maxsize=int(os.getenv("IMAGE_PREP_LOCAL_SIZE", "128")))
+
+
+def _encode_for_target(raw: bytes, max_side: int) -> bytes:
+    """Decode, downscale and re-encode as JPEG. CPU-bound: run in a thread."""
+    with Image.open(io.BytesIO(raw)) as image:
+        image.draft("RGB", (max_side, max_side))  # cheap JPEG downscale during decode
+        image = image.convert("RGB")
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+        return buffer.getvalue()
+
+
+async def _download(url: str) -> bytes:
+    if url.startswith("/") or url.startswith("./"):
+        return await asyncio.to_thread(lambda: open(url, "rb").read())
+    resp = await get_http_client().get(url)
+    resp.raise_for_status()
+    return resp.content
+
+
+async def prepare_image(url: str, target: str, content_hash: Optional[str] = None) -> bytes:
+    """
+    Return JPEG bytes of `url` sized for `target` ("gemini" or "openai").
+
+    Prepared bytes are cached by content hash (the upload-time SHA-256 for
+    reference images, the URL hash otherwise), in-process and in Redis, so
+    the same image is downloaded and re-encoded once across all jobs.
+    """
+    digest = content_hash or hashlib.sha256(url.encode()).hexdigest()
+    cache_key = f"{PREP_CACHE_PREFIX}:{target}:{digest}"
+
+    prepared = _local_cache.get(cache_key)
+    if prepared is not None:
+        return prepared
+
+    cached = await redis_conn.get(cache_key)
+    if cached:
+        prepared = base64.b64decode(cached)
+    else:
+        raw = await _download(url)
+        prepared = await asyncio.to_thread(_encode_for_target, raw, TARGET_MAX_SIDE[target])
+        await redis_conn.setex(cache_key, PREP_CACHE_TTL, base64.b64encode(prepared).decode())
+
+    _local_cache[cache_key] = prepared
+    return prepared
+
+
+async def prepare_images(urls: List[str], target: str, content_hashes: Optional[List[str]] = None) -> List[bytes]:
+    """Prepare several images concurrently, preserving order."""
+    hashes = content_hashes if content_hashes and len(content_hashes) == len(urls) else [None] * len(urls)
+    return await asyncio.gather(*(prepare_image(u, target, h) for u, h in zip(urls, hashes)))
+
+
+def to_data_url(image_bytes: bytes, mime_type: str = "image/jpeg") -> str:
+    return f"data:{mime_type};base64,{base64.b64encode(image_bytes).decode()}"
@@ -0,0 +1,158 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Dict
+from dotenv import load_dotenv
+from app.db.queue_connection import redis_conn
+from app.db.repository import update_prompt
+
+load_dotenv()
+logger = logging.getLogger("coverly.job_state")
+
+# While a job runs, a Redis hash (job_state:{job_id}) records the rank of its
+# current status so transitions only move forward. Field updates are merged
+# into a pending hash and the worker running the job flushes them to
+# thumbnail_prompts in the background, so most DB writes are off the job's
+# critical path. Terminal states are flushed straight away.
+STATE_PREFIX = "job_state"
+PENDING_PREFIX = "job_state:pending"
+JOB_STATE_TTL = int(os.getenv("JOB_STATE_TTL", str(24 * 3600)))
+FLUSH_INTERVAL = float(os.getenv("JOB_STATE_FLUSH_INTERVAL", "1"))
+
+TERMINAL_STATUSES = {"completed", "failed"}
+
+# Status only moves forward. A provider failing after the other one has
+# completed (generator "both") can no longer overwrite "completed".
+STATUS_RANK = {
+    "queued": 0,
+    "refining_prompt": 1,
+    "refined": 2,
+    "fetching_youtube": 3,
+    "videos_fetched": 4,
+    "failed": 8,
+    "completed": 9,
+}
+
+# KEYS: state, pending | ARGV: ttl, status rank (-1 if none), force, field, value, ...
+# Returns 0 if the status change was rejected as a regression, else 1
+_WRITE_SCRIPT = """
+local rank = tonumber(ARGV[2])
+local skip_status = false
+if rank >= 0 and ARGV[3] ~= '1' then
+    local current = tonumber(redis.call('HGET', KEYS[1], '_rank') or '-1')
+    skip_status = rank < current
+end
+local written = 0
+for i = 4, #ARGV, 2 do
+    if not (skip_status and ARGV[i] == 'status') then
+        redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 1])
+        written = written + 1
+    end
+end
+if rank >= 0 and not skip_status then
+    redis.call('HSET', KEYS[1], '_rank', rank)
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+if written > 0 then
+    redis.call('EXPIRE', KEYS[2], ARGV[1])
+end
+if skip_status then
+    return 0
+end
+return 1
+"""
+
+# KEYS: pending. Hand over everything pending and clear it in one step.
+_TAKE_SCRIPT = """
+local fields = redis.call('HGETALL', KEYS[1])
+redis.call('DEL', KEYS[1])
+return fields
+"""
+
+_write = redis_conn.register_script(_WRITE_SCRIPT)
+_take = redis_conn.register_script(_TAKE_SCRIPT)
+
+# A job runs on one worker at a time, so the dirty set and flush locks are
+# per process; the lock keeps flushes of one job in order.
+_dirty: set[str] = set()
+_locks: Dict[str, asyncio.Lock] = {}
+
+
+def _keys(job_id: str) -> list[str]:
+    return [f"{STATE_PREFIX}:{job_id}", f"{PENDING_PREFIX}:{job_id}"]
+
+
+async def write_job_state(job_id: str, fields: dict, force: bool = False, flush: bool = False) -> bool:
+    """
+    Merge `fields` into the job's state. A status that would move the job
+    backwards is dropped unless `force` is set; other fields are still
+    written. Terminal statuses (or `flush=True`) are persisted immediately.
+    Returns False if the status change was rejected.
+    """
+    status = fields.get("status")
+    rank = STATUS_RANK.get(status, 0) if status else -1
+    args = [JOB_STATE_TTL, rank, "1" if force else "0"]
+    for field, value in fields.items():
+        args += [field, json.dumps(value)]
+
+    applied = await _write(keys=_keys(job_id), args=args)
+    _dirty.add(job_id)
+    if flush or (applied and status in TERMINAL_STATUSES):
+        try:
+            await flush_job_state(job_id)
+        except Exception as e:
+            # Still pending; the background flusher retries
+            logger.error(f"Immediate flush failed for job {job_id}: {e}")
+    return bool(applied)
+
+
+async def reset_job_state(job_id: str):
+    """Start a (re)run from a clean slate so its statuses aren't judged against a previous attempt."""
+    await redis_conn.delete(f"{STATE_PREFIX}:{job_id}")
+
+
+async def flush_job_state(job_id: str):
+    lock = _locks.setdefault(job_id, asyncio.Lock())
+    try:
+        async with lock:
+            _dirty.discard(job_id)
+            raw = await _take(keys=[_keys(job_id)[1]])
+            if raw:
+                await _persist(job_id, dict(zip(raw[::2], raw[1::2])))
+    finally:
+        if job_id not in _dirty and not lock.locked():
+            _locks.pop(job_id, None)
+
+
+async def _persist(job_id: str, pending: dict):
+    try:
+        await update_prompt(job_id, {field: json.loads(value) for field, value in pending.items()})
+    except Exception:
+        # Put the fields back unless something newer has been written meanwhile
+        pending_key = _keys(job_id)[1]
+        async with redis_conn.pipeline(transaction=False) as pipe:
+            for field, value in pending.items():
+                pipe.hsetnx(pending_key, field, value)
+            pipe.expire(pending_key, JOB_STATE_TTL)
+            await pipe.execute()
+        _dirty.add(job_id)
+        raise
+
+
+async def flush_all_job_states():
+    jobs = list(_dirty)
+    results = await asyncio.gather(*(flush_job_state(job_id) for job_id in jobs), return_exceptions=True)
+    for job_id, result in zip(jobs, results):
+        if isinstance(result, Exception):
+            logger.error(f"Job state flush failed for {job_id}: {result}")
+
+
+async def job_state_flush_loop(stop_event: asyncio.Event):
+    while not stop_event.is_set():
+        await flush_all_job_states()
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+    await flush_all_job_states()
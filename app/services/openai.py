@@ -1,26 +1,24 @@
-from openai import OpenAI
 from ..utils.system_prompts import build_thumbnail_system_prompt_openai
-from ..utils.image_utils import prepare_image_for_openai
+from .clients import get_openai_client
+from .image_prep import prepare_image, to_data_url
 from dotenv import load_dotenv
-import os
 
 
 load_dotenv()
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
-
-async def thumbnail_generation(refined_prompt: str, reference_images, youtube_reference_images,aspect_ratio,platform):
+async def thumbnail_generation(refined_prompt: str, reference_images, youtube_reference_images,aspect_ratio,platform,reference_hashes=None):
 
     system_prompt = build_thumbnail_system_prompt_openai(refined_prompt,aspect_ratio,platform)
+    user_content = [{"type": "input_text", "text": refined_prompt}]
     if reference_images:
-        prepared = prepare_image_for_openai(reference_images[0])
-        if prepared:
-            if prepared.startswith("http"):
-                image_input = {"type": "input_image", "image_url": prepared}
-            else:
-                image_input = {"type": "input_image", "image_url": f"data:image/jpeg;base64,{prepared}"}
-    response = client.responses.create(
+        try:
+            prepared = await prepare_image(reference_images[0], "openai", (reference_hashes or [None])[0])
+            user_content.append({"type": "input_image", "image_url": to_data_url(prepared)})
+        except Exception as e:
+            print(f"[thumbnail_generation] Failed to prepare reference image, continuing without it: {e}")
+
+    response = await get_openai_client().responses.create(
                 model="gpt-4.1",
                 input=[
                     {
@@ -31,10 +29,7 @@ async def thumbnail_generation(refined_prompt: str, reference_images, youtube_re
                     },
                         {
                             "role": "user",
-                            "content": [
-                                {"type": "input_text", "text": refined_prompt},
-                                image_input,
-                            ],
+                            "content": user_content,
                         },
                     ],
                 tools=[{"type": "image_generation"}],
@@ -52,6 +47,3 @@ async def thumbnail_generation(refined_prompt: str, reference_images, youtube_re
     else:
         print("⚠️ No image generated:", response.output)
         return None
-
-
-
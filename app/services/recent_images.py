@@ -0,0 +1,102 @@
+import json
+import logging
+import os
+from typing import List
+from dotenv import load_dotenv
+from app.db.queue_connection import redis_conn
+from app.db.repository import latest_generated_images
+from app.services.url_signer import image_refs
+
+load_dotenv()
+logger = logging.getLogger("coverly.recent_images")
+
+# Newest-first list of image-key batches per user (one entry per completed
+# generation), kept by the worker and trimmed to RECENT_IMAGES_MAX entries.
+# A meta hash records whether the list has been seeded from the DB and a
+# generation counter, so a seed computed from a read that raced a completion
+# is discarded instead of hiding the new images.
+RECENT_IMAGES_PREFIX = "recent_images"
+RECENT_IMAGES_MAX = int(os.getenv("RECENT_IMAGES_MAX", "20"))
+RECENT_IMAGES_TTL = int(os.getenv("RECENT_IMAGES_TTL", str(7 * 24 * 3600)))
+
+# KEYS: list, meta | ARGV: entry, max, ttl
+_PUSH_SCRIPT = """
+redis.call('HINCRBY', KEYS[2], 'gen', 1)
+if redis.call('HGET', KEYS[2], 'seeded') == '1' then
+    redis.call('LPUSH', KEYS[1], ARGV[1])
+    redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[2]) - 1)
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+end
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return 1
+"""
+
+# KEYS: list, meta | ARGV: generation seen before the DB read, ttl, entries...
+_SEED_SCRIPT = """
+if redis.call('HGET', KEYS[2], 'seeded') == '1' then
+    return 0
+end
+if tonumber(redis.call('HGET', KEYS[2], 'gen') or '0') ~= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+if #ARGV > 2 then
+    redis.call('RPUSH', KEYS[1], unpack(ARGV, 3))
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+redis.call('HSET', KEYS[2], 'seeded', 1)
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+return 1
+"""
+
+_push = redis_conn.register_script(_PUSH_SCRIPT)
+_seed = redis_conn.register_script(_SEED_SCRIPT)
+
+
+def _keys(user_id: str) -> List[str]:
+    return [f"{RECENT_IMAGES_PREFIX}:{user_id}", f"{RECENT_IMAGES_PREFIX}:{user_id}:meta"]
+
+
+def _flatten(entries: List[List[str]]) -> List[str]:
+    """Newest first, each image once."""
+    return list(dict.fromkeys(ref for entry in entries for ref in entry))
+
+
+async def push_recent_images(user_id: str, image_keys: List[str]):
+    """Record a completed generation at the head of the user's list."""
+    if not user_id or not image_keys:
+        return
+    try:
+        await _push(keys=_keys(user_id), args=[json.dumps(image_keys), RECENT_IMAGES_MAX, RECENT_IMAGES_TTL])
+    except Exception as e:
+        # The images are saved either way; a failed push only costs freshness
+        logger.error(f"Could not record recent images for {user_id}: {e}")
+
+
+async def recent_images(user_id: str, limit: int) -> List[str]:
+    """
+    Image keys from the user's `limit` latest generations. Warm users cost
+    one Redis round trip; cold users are read from the DB once and seeded.
+    """
+    list_key, meta_key = _keys(user_id)
+    async with redis_conn.pipeline(transaction=False) as pipe:
+        pipe.lrange(list_key, 0, limit - 1)
+        pipe.hmget(meta_key, "seeded", "gen")
+        cached, (seeded, gen) = await pipe.execute()
+
+    if seeded == "1":
+        return _flatten(json.loads(entry) for entry in cached)
+
+    rows = await latest_generated_images(user_id, RECENT_IMAGES_MAX)
+    entries = [
+        images for images in (
+            image_refs(row.get("generated_images")) + image_refs(row.get("generated_images_gemini"))
+            for row in rows
+        )
+        if images
+    ]
+    await _seed(
+        keys=[list_key, meta_key],
+        args=[int(gen or 0), RECENT_IMAGES_TTL, *(json.dumps(entry) for entry in entries)],
+    )
+    return _flatten(entries[:limit])
@@ -0,0 +1,198 @@
+import base64
+import hashlib
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable
+import numpy as np
+from cachetools import TTLCache
+from dotenv import load_dotenv
+from app.db.queue_connection import redis_conn
+from .clients import get_openai_client
+
+load_dotenv()
+
+# Two-layer cache for prompt refinement results ({"refined_prompt", "title"}):
+#   1. exact   - keyed on the normalized (query, platform, aspect ratio);
+#                in-process LRU in front of a shared Redis entry.
+#   2. semantic - embeddings of recent queries, cosine-searched with NumPy;
+#                 reuses a refinement when a new query is close enough.
+CACHE_PREFIX = "refine_cache"
+METRICS_KEY = f"{CACHE_PREFIX}:metrics"
+CACHE_TTL = int(os.getenv("REFINE_CACHE_TTL", str(24 * 3600)))
+LOCAL_CACHE_SIZE = int(os.getenv("REFINE_CACHE_LOCAL_SIZE", "1024"))
+SEMANTIC_ENABLED = os.getenv("REFINE_SEMANTIC_CACHE", "true").lower() in ("1", "true", "yes")
+SEMANTIC_THRESHOLD = float(os.getenv("REFINE_SEMANTIC_THRESHOLD", "0.95"))
+SEMANTIC_CAPACITY = int(os.getenv("REFINE_SEMANTIC_CAPACITY", "500"))
+SEMANTIC_SYNC_INTERVAL = float(os.getenv("REFINE_SEMANTIC_SYNC_INTERVAL", "60"))
+EMBEDDING_MODEL = os.getenv("REFINE_EMBEDDING_MODEL", "text-embedding-3-small")
+
+_exact_local: TTLCache = TTLCache(maxsize=LOCAL_CACHE_SIZE, ttl=CACHE_TTL)
+# Hit/miss counters live in Redis so the API can report them for all workers
+METRICS = ("exact_hits", "semantic_hits", "misses")
+
+
+def normalize_query(user_query: str | None) -> str:
+    return re.sub(r"\s+", " ", (user_query or "").strip().lower())
+
+
+def _exact_key(query: str, platform: str, aspect_ratio: str) -> str:
+    raw = json.dumps([query, (platform or "").lower(), aspect_ratio or ""])
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class SemanticIndex:
+    """
+    Recent (embedding, refinement) pairs for one platform/aspect ratio.
+    Bounded LRU with TTL, mirrored to a capped Redis list so every worker
+    process searches the same recent history.
+    """
+
+    def __init__(self, scope: str):
+        self.redis_key = f"{CACHE_PREFIX}:semantic:{scope}"
+        self.entries: OrderedDict[str, tuple[np.ndarray, dict, float]] = OrderedDict()
+        self._matrix: np.ndarray | None = None
+        self._ids: list[str] = []
+        self._synced_at = 0.0
+
+    def _invalidate(self):
+        self._matrix = None
+
+    def _evict_expired(self):
+        cutoff = time.time() - CACHE_TTL
+        for entry_id in [k for k, (_, _, ts) in self.entries.items() if ts < cutoff]:
+            del self.entries[entry_id]
+            self._invalidate()
+
+    def _add_local(self, entry_id: str, vector: np.ndarray, value: dict, ts: float):
+        self.entries[entry_id] = (vector, value, ts)
+        self.entries.move_to_end(entry_id)
+        while len(self.entries) > SEMANTIC_CAPACITY:
+            self.entries.popitem(last=False)
+        self._invalidate()
+
+    async def sync(self):
+        """Pull entries other workers added since the last sync."""
+        if time.time() - self._synced_at < SEMANTIC_SYNC_INTERVAL:
+            return
+        self._synced_at = time.time()
+        for raw in reversed(await redis_conn.lrange(self.redis_key, 0, SEMANTIC_CAPACITY - 1)):
+            item = json.loads(raw)
+            if item["id"] in self.entries:
+                continue
+            vector = np.frombuffer(base64.b64decode(item["embedding"]), dtype=np.float32)
+            self._add_local(item["id"], vector, item["value"], item["ts"])
+        self._evict_expired()
+
+    def search(self, vector: np.ndarray) -> dict | None:
+        if not self.entries:
+            return None
+        if self._matrix is None:
+            self._ids = list(self.entries.keys())
+            self._matrix = np.stack([self.entries[i][0] for i in self._ids])
+        # Embeddings are unit-normalized, so the dot product is the cosine similarity
+        scores = self._matrix @ vector
+        best = int(np.argmax(scores))
+        if scores[best] < SEMANTIC_THRESHOLD:
+            return None
+        entry_id = self._ids[best]
+        self.entries.move_to_end(entry_id)
+        return self.entries[entry_id][1]
+
+    async def add(self, entry_id: str, vector: np.ndarray, value: dict):
+        ts = time.time()
+        self._add_local(entry_id, vector, value, ts)
+        item = json.dumps({
+            "id": entry_id,
+            "embedding": base64.b64encode(vector.astype(np.float32).tobytes()).decode(),
+            "value": value,
+            "ts": ts,
+        })
+        async with redis_conn.pipeline(transaction=False) as pipe:
+            pipe.lpush(self.redis_key, item)
+            pipe.ltrim(self.redis_key, 0, SEMANTIC_CAPACITY - 1)
+            pipe.expire(self.redis_key, CACHE_TTL)
+            await pipe.execute()
+
+
+_indexes: dict[str, SemanticIndex] = {}
+
+
+def _semantic_index(platform: str, aspect_ratio: str) -> SemanticIndex:
+    scope = f"{(platform or '').lower()}:{aspect_ratio or ''}"
+    if scope not in _indexes:
+        _indexes[scope] = SemanticIndex(scope)
+    return _indexes[scope]
+
+
+async def _embed(text: str) -> np.ndarray:
+    response = await get_openai_client().embeddings.create(model=EMBEDDING_MODEL, input=text)
+    vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+    return vector / (np.linalg.norm(vector) or 1.0)
+
+
+async def _record(metric: str):
+    try:
+        await redis_conn.hincrby(METRICS_KEY, metric, 1)
+    except Exception:
+        pass  # metrics must never fail a job
+
+
+async def refine_cache_stats() -> dict:
+    """Hit/miss counters across every worker."""
+    counts = await redis_conn.hgetall(METRICS_KEY)
+    metrics = {name: int(counts.get(name, 0)) for name in METRICS}
+    total = sum(metrics.values())
+    hits = metrics["exact_hits"] + metrics["semantic_hits"]
+    return {**metrics, "hit_rate": round(hits / total, 3) if total else 0.0}
+
+
+async def cached_refinement(
+    user_query: str,
+    platform: str,
+    aspect_ratio: str,
+    refine: Callable[[], Awaitable[dict]],
+) -> dict:
+    """
+    Return `{"refined_prompt", "title"}` for the inputs, calling `refine`
+    only when neither cache layer has a usable entry.
+    """
+    query = normalize_query(user_query)
+    key = _exact_key(query, platform, aspect_ratio)
+
+    value = _exact_local.get(key)
+    if value is None:
+        cached = await redis_conn.get(f"{CACHE_PREFIX}:{key}")
+        if cached:
+            value = json.loads(cached)
+            _exact_local[key] = value
+    if value is not None:
+        await _record("exact_hits")
+        return value
+
+    vector = None
+    index = None
+    if SEMANTIC_ENABLED and query:
+        try:
+            index = _semantic_index(platform, aspect_ratio)
+            await index.sync()
+            vector = await _embed(query)
+            value = index.search(vector)
+        except Exception as e:
+            print(f"[RefineCache] Semantic lookup skipped: {e}")
+            vector = None
+        if value is not None:
+            await _record("semantic_hits")
+            _exact_local[key] = value
+            return value
+
+    await _record("misses")
+    value = await refine()
+
+    _exact_local[key] = value
+    await redis_conn.setex(f"{CACHE_PREFIX}:{key}", CACHE_TTL, json.dumps(value))
+    if vector is not None:
+        await index.add(key, vector, value)
+    return value
@@ -1,24 +1,21 @@
-from openai import OpenAI
+import hashlib
+import json
+import os
 from dotenv import load_dotenv
 from langsmith import traceable
-import os
+from .clients import get_openai_client
 
 load_dotenv()
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# "split": refine_prompt then extract_title (two calls).
+# "combined": one structured call returning both.
+# "ab": combined for REFINE_AB_RATIO of jobs (bucketed by job_id), split otherwise.
+REFINE_MODE = os.getenv("REFINE_MODE", "combined").lower()
+REFINE_AB_RATIO = float(os.getenv("REFINE_AB_RATIO", "0.5"))
 
 
-@traceable(
-    name="OpenAI Prompt Refinement",
-    metadata={"model": "gpt-4.1-mini", "tool": "refine_prompt"}
-)
-
-async def refine_prompt(user_prompt: str,aspect_ratio=str,platform=str) -> str:
-    """
-    Refines a user-provided prompt to make it clearer, more detailed, and actionable.
-    Ensures any reference images are respected (faces unchanged).
-    """
-    prompt = f"""
+def _refinement_brief(user_prompt: str, aspect_ratio: str, platform: str) -> str:
+    return f"""
     You are an AI assistant specialized in refining prompts for maximum clarity and effectiveness.
 
     Original Prompt:
@@ -38,9 +35,24 @@ async def refine_prompt(user_prompt: str,aspect_ratio=str,platform=str) -> str:
     - Leave comfortable padding on all sides.
     - Provide an example or template for the desired output format.
 
+"""
+
+
+@traceable(
+    name="OpenAI Prompt Refinement",
+    metadata={"model": "gpt-4.1-mini", "tool": "refine_prompt"}
+)
+
+async def refine_prompt(user_prompt: str,aspect_ratio=str,platform=str) -> str:
+    """
+    Refines a user-provided prompt to make it clearer, more detailed, and actionable.
+    Ensures any reference images are respected (faces unchanged).
+    """
+    prompt = f"""
+{_refinement_brief(user_prompt, aspect_ratio, platform)}
     Refine the original prompt following these guidelines.
     """
-    response = client.chat.completions.create(
+    response = await get_openai_client().chat.completions.create(
         model="gpt-4.1-mini",  
         messages=[{"role": "user", "content": prompt}],
         temperature=0.7,
@@ -68,9 +80,76 @@ async def extract_title(video_context: str,platform=str) -> str:
     it should look like a professional {platform} title.
     Should be short and engaging.
     """
-    response = client.chat.completions.create(
+    response = await get_openai_client().chat.completions.create(
         model="gpt-4.1-mini",  
         messages=[{"role": "user", "content": prompt}],
         temperature=0.7,
     )
     return response.choices[0].message.content.strip()
+
+
+REFINEMENT_SCHEMA = {
+    "name": "thumbnail_refinement",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "refined_prompt": {"type": "string"},
+            "title": {"type": "string"},
+        },
+        "required": ["refined_prompt", "title"],
+        "additionalProperties": False,
+    },
+}
+
+
+@traceable(
+    name="OpenAI Prompt Refinement + Title",
+    metadata={"model": "gpt-4.1-mini", "tool": "refine_prompt_with_title"}
+)
+async def refine_prompt_with_title(user_prompt: str, aspect_ratio=str, platform=str) -> dict:
+    """
+    Refines the prompt and generates the platform title in a single
+    structured-output call. Returns {"refined_prompt": ..., "title": ...}.
+    """
+    prompt = f"""
+{_refinement_brief(user_prompt, aspect_ratio, platform)}
+    Refine the original prompt following these guidelines and return it as `refined_prompt`.
+
+    Then, acting as an expert in creating trending and clickable {platform} titles,
+    write a catchy, search-optimized {platform} title for the refined prompt that
+    maximizes click-through rate. It should look like a professional {platform} title,
+    short and engaging, and contain only the title text. Return it as `title`.
+    """
+    response = await get_openai_client().chat.completions.create(
+        model="gpt-4.1-mini",
+        messages=[{"role": "user", "content": prompt}],
+        temperature=0.7,
+        response_format={"type": "json_schema", "json_schema": REFINEMENT_SCHEMA},
+    )
+    result = json.loads(response.choices[0].message.content)
+    return {
+        "refined_prompt": result["refined_prompt"].strip(),
+        "title": result["title"].strip().strip('"'),
+    }
+
+
+def refinement_mode(job_id: str) -> str:
+    """Resolve REFINE_MODE for a job; "ab" buckets jobs deterministically."""
+    if REFINE_MODE != "ab":
+        return "split" if REFINE_MODE == "split" else "combined"
+    bucket = int(hashlib.sha256(job_id.encode()).hexdigest()[:8], 16) / 0xFFFFFFFF
+    return "combined" if bucket < REFINE_AB_RATIO else "split"
+
+
+async def refine_prompt_and_title(user_prompt: str, aspect_ratio: str, platform: str, job_id: str) -> dict:
+    """Refined prompt and title using the mode selected for this job."""
+    mode = refinement_mode(job_id)
+    if mode == "combined":
+        result = await refine_prompt_with_title(user_prompt, aspect_ratio=aspect_ratio, platform=platform)
+    else:
+        refined = await refine_prompt(user_prompt, aspect_ratio=aspect_ratio, platform=platform)
+        title = await extract_title(refined, platform=platform)
+        result = {"refined_prompt": refined, "title": title}
+    print(f"[Refine] Job {job_id} refined with mode={mode}")
+    return {**result, "refine_mode": mode}
@@ -0,0 +1,194 @@
+import hashlib
+import json
+import logging
+import os
+import re
+from typing import List, Optional, Tuple
+from dotenv import load_dotenv
+from app.db.queue_connection import redis_conn
+from app.services.credit_ledger import refund_credit
+from app.services.history_cache import invalidate_history
+from app.services.job_state import write_job_state
+
+load_dotenv()
+logger = logging.getLogger("coverly.coalescing")
+
+# Identical submissions share one job. A request is identified by the
+# client's Idempotency-Key (per user) or by a fingerprint of everything that
+# determines the output. The first request for a fingerprint leads; repeats
+# from the same user get the leader's job back, other users get a follower
+# job of their own whose WebSocket stream is the leader's and whose record
+# is filled in by the worker when the leader finishes.
+IDEMPOTENCY_PREFIX = "idem"
+LEADER_PREFIX = "coalesce"
+FOLLOWERS_PREFIX = "coalesce:followers"
+ALIAS_PREFIX = "job_alias"
+RESULT_PREFIX = "request_result"
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", str(24 * 3600)))
+# How long a finished job keeps absorbing identical requests
+COALESCE_WINDOW = int(os.getenv("COALESCE_WINDOW", "60"))
+# Upper bound on a leader's claim while its job is queued or running
+COALESCE_MAX_INFLIGHT = int(os.getenv("COALESCE_MAX_INFLIGHT", "900"))
+ALIAS_TTL = int(os.getenv("JOB_ALIAS_TTL", str(24 * 3600)))
+# Finished results by fingerprint, so repeats can complete without the queue
+RESULT_TTL = int(os.getenv("REQUEST_RESULT_TTL", os.getenv("GENERATION_CACHE_TTL", str(7 * 24 * 3600))))
+
+# KEYS: followers, closed marker, alias | ARGV: follower entry, leader job_id, ttl
+# Refuses once the leader has fanned out, so no follower is ever orphaned
+_FOLLOW_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 0
+end
+redis.call('SADD', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('SET', KEYS[3], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+# KEYS: followers, closed marker | ARGV: ttl
+_TAKE_FOLLOWERS_SCRIPT = """
+redis.call('SET', KEYS[2], 1, 'EX', ARGV[1])
+local followers = redis.call('SMEMBERS', KEYS[1])
+redis.call('DEL', KEYS[1])
+return followers
+"""
+
+# KEYS: leader claim | ARGV: job_id, window (0 = delete)
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if tonumber(ARGV[2]) > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+else
+    redis.call('DEL', KEYS[1])
+end
+return 1
+"""
+
+_follow = redis_conn.register_script(_FOLLOW_SCRIPT)
+_take_followers = redis_conn.register_script(_TAKE_FOLLOWERS_SCRIPT)
+_release = redis_conn.register_script(_RELEASE_SCRIPT)
+
+
+def request_fingerprint(
+    user_query: Optional[str],
+    platform: Optional[str],
+    aspect_ratio: Optional[str],
+    reference_hashes: List[str],
+    generator_provider: Optional[str],
+) -> str:
+    normalized = {
+        "query": re.sub(r"\s+", " ", (user_query or "").strip()),
+        "platform": (platform or "").strip().lower(),
+        "aspect_ratio": (aspect_ratio or "").strip(),
+        "references": sorted(reference_hashes or []),
+        "provider": (generator_provider or "").strip().lower(),
+    }
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+
+# ----------------------
+# Idempotency keys
+# ----------------------
+async def claim_idempotency_key(user_id: str, key: str, job_id: str) -> Optional[str]:
+    """Bind `key` to `job_id`. Returns the job it is already bound to, or None if the claim is ours."""
+    redis_key = f"{IDEMPOTENCY_PREFIX}:{user_id}:{key}"
+    if await redis_conn.set(redis_key, job_id, nx=True, ex=IDEMPOTENCY_TTL):
+        return None
+    return await redis_conn.get(redis_key)
+
+
+async def bind_idempotency_key(user_id: str, key: str, job_id: str):
+    await redis_conn.set(f"{IDEMPOTENCY_PREFIX}:{user_id}:{key}", job_id, ex=IDEMPOTENCY_TTL)
+
+
+async def release_idempotency_key(user_id: str, key: str):
+    await redis_conn.delete(f"{IDEMPOTENCY_PREFIX}:{user_id}:{key}")
+
+
+# ----------------------
+# Leaders and followers
+# ----------------------
+async def claim_leader(fingerprint: str, job_id: str, user_id: str) -> Optional[Tuple[str, str]]:
+    """
+    Make `job_id` the leader for `fingerprint`. Returns None if it now leads,
+    otherwise the current leader's (job_id, user_id).
+    """
+    key = f"{LEADER_PREFIX}:{fingerprint}"
+    if await redis_conn.set(key, f"{job_id}|{user_id}", nx=True, ex=COALESCE_MAX_INFLIGHT):
+        return None
+    current = await redis_conn.get(key)
+    if current is None:
+        # Expired between the two calls; try once more
+        if await redis_conn.set(key, f"{job_id}|{user_id}", nx=True, ex=COALESCE_MAX_INFLIGHT):
+            return None
+        current = await redis_conn.get(key) or f"{job_id}|{user_id}"
+    leader_job, _, leader_user = current.partition("|")
+    return leader_job, leader_user
+
+
+async def release_leader(fingerprint: Optional[str], job_id: str, user_id: str, completed: bool):
+    """
+    Called when the leader finishes. A completed job keeps absorbing repeats
+    for COALESCE_WINDOW; a failed one stops at once so retries do new work.
+    """
+    if not fingerprint:
+        return
+    await _release(
+        keys=[f"{LEADER_PREFIX}:{fingerprint}"],
+        args=[f"{job_id}|{user_id}", COALESCE_WINDOW if completed else 0],
+    )
+
+
+async def add_follower(leader_job_id: str, job_id: str, user_id: str) -> bool:
+    """Attach a follower job to a leader. False if the leader has already finished."""
+    followers_key = f"{FOLLOWERS_PREFIX}:{leader_job_id}"
+    attached = await _follow(
+        keys=[followers_key, f"{followers_key}:closed", f"{ALIAS_PREFIX}:{job_id}"],
+        args=[json.dumps({"job_id": job_id, "user_id": user_id}), leader_job_id, ALIAS_TTL],
+    )
+    return bool(attached)
+
+
+async def take_followers(leader_job_id: str) -> List[dict]:
+    """Close the leader to new followers and hand back the attached ones."""
+    followers_key = f"{FOLLOWERS_PREFIX}:{leader_job_id}"
+    raw = await _take_followers(keys=[followers_key, f"{followers_key}:closed"], args=[ALIAS_TTL])
+    return [json.loads(entry) for entry in raw]
+
+
+async def fail_followers(leader_job_id: str):
+    """
+    Close a leader that will not produce a result and fail every follower
+    attached to it: record marked failed, history dropped, credit refunded.
+    """
+    for follower in await take_followers(leader_job_id):
+        follower_job, follower_user = follower["job_id"], follower["user_id"]
+        await write_job_state(follower_job, {"status": "failed"})
+        await invalidate_history(follower_user)
+        await refund_credit(follower_user, follower_job)
+        logger.info(f"Job {follower_job} failed with leader {leader_job_id}")
+
+
+async def stream_job_id(job_id: str) -> str:
+    """The job whose event stream `job_id` follows (itself unless coalesced)."""
+    return await redis_conn.get(f"{ALIAS_PREFIX}:{job_id}") or job_id
+
+
+# ----------------------
+# Finished results
+# ----------------------
+async def store_request_result(fingerprint: Optional[str], result: dict):
+    """Remember a completed job's output (S3 keys, title, refined prompt) under its fingerprint."""
+    if fingerprint:
+        await redis_conn.set(f"{RESULT_PREFIX}:{fingerprint}", json.dumps(result), ex=RESULT_TTL)
+
+
+async def lookup_fingerprint(fingerprint: str) -> Tuple[Optional[Tuple[str, str]], Optional[dict]]:
+    """Current leader (job_id, user_id) and finished result for `fingerprint`, in one round trip."""
+    leader, result = await redis_conn.mget([f"{LEADER_PREFIX}:{fingerprint}", f"{RESULT_PREFIX}:{fingerprint}"])
+    if leader:
+        leader_job, _, leader_user = leader.partition("|")
+        leader = (leader_job, leader_user)
+    return leader, json.loads(result) if result else None
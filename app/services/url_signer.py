@@ -0,0 +1,115 @@
+import os
+import time
+from typing import Iterable, List, Optional
+from urllib.parse import unquote, urlsplit
+from dotenv import load_dotenv
+from app.db.queue_connection import redis_conn
+from app.db.storage import AWS_REGION, BUCKETS, get_storage
+
+load_dotenv()
+
+# Jobs persist S3 keys only; URLs are signed when something is read.
+# Signed URLs are cached in-process and in Redis and re-signed once less
+# than REFRESH_MARGIN of their lifetime is left, so a client never gets a
+# link that is about to die.
+SIGNED_URL_TTL = int(os.getenv("SIGNED_URL_TTL", str(12 * 3600)))
+REFRESH_MARGIN = int(os.getenv("SIGNED_URL_REFRESH_MARGIN", str(30 * 60)))
+LOCAL_CACHE_SIZE = int(os.getenv("SIGNED_URL_LOCAL_SIZE", "4096"))
+CACHE_PREFIX = "signed_url"
+
+# (role, key) -> (url, expires_at)
+_local: dict[tuple[str, str], tuple[str, float]] = {}
+
+
+def storage_key(ref: str, role: str = "generated") -> Optional[str]:
+    """
+    S3 key for a stored reference. Plain keys are returned as-is; presigned
+    URLs for our buckets (rows written before keys were persisted) have the
+    key extracted so they can be re-signed. Foreign URLs return None.
+    """
+    if not ref:
+        return None
+    if not ref.startswith("http"):
+        return ref
+    bucket = BUCKETS.get(role)
+    if not bucket:
+        return None
+    parts = urlsplit(ref)
+    if parts.scheme != "https":
+        return None
+    # The whole netloc is compared, so userinfo or a port never matches
+    host = parts.netloc.lower()
+    path = unquote(parts.path)
+    # Exact S3 endpoints only: virtual-hosted or path-style, regional or the legacy global one
+    if host in (f"{bucket}.s3.{AWS_REGION}.amazonaws.com", f"{bucket}.s3.amazonaws.com"):
+        return path.lstrip("/") or None
+    if host in (f"s3.{AWS_REGION}.amazonaws.com", "s3.amazonaws.com") and path.startswith(f"/{bucket}/"):
+        return path[len(bucket) + 2:] or None
+    return None
+
+
+def image_refs(images) -> List[str]:
+    """Stored image references from a generated_images column."""
+    # Older rows hold {"url": ...} entries
+    refs = [i.get("url") if isinstance(i, dict) else i for i in images or []]
+    return [r for r in refs if isinstance(r, str)]
+
+
+def _fresh(entry) -> bool:
+    return entry is not None and entry[1] - time.time() > REFRESH_MARGIN
+
+
+def _remember(role: str, key: str, url: str, expires_at: float):
+    if len(_local) >= LOCAL_CACHE_SIZE:
+        # Drop the oldest-inserted entry; dicts preserve insertion order
+        _local.pop(next(iter(_local)))
+    _local[(role, key)] = (url, expires_at)
+
+
+async def sign_urls(refs: Iterable[str], role: str = "generated") -> List[str]:
+    """
+    Batch-sign stored references, preserving order. Foreign URLs (e.g.
+    YouTube thumbnails) pass through untouched. One Redis round trip covers
+    every reference missing from the in-process cache.
+    """
+    refs = list(refs)
+    keys = [storage_key(r, role) for r in refs]
+    result: List[Optional[str]] = [None] * len(refs)
+
+    missing = []
+    for i, key in enumerate(keys):
+        if key is None:
+            result[i] = refs[i]
+            continue
+        entry = _local.get((role, key))
+        if _fresh(entry):
+            result[i] = entry[0]
+        else:
+            missing.append(i)
+
+    if missing:
+        redis_keys = [f"{CACHE_PREFIX}:{role}:{keys[i]}" for i in missing]
+        cached = await redis_conn.mget(redis_keys)
+        to_store = {}
+        storage = get_storage(role)
+        for i, value in zip(missing, cached):
+            key = keys[i]
+            if value:
+                url, _, expires_at = value.rpartition("|")
+                if _fresh((url, float(expires_at))):
+                    _remember(role, key, url, float(expires_at))
+                    result[i] = url
+                    continue
+            expires_at = time.time() + SIGNED_URL_TTL
+            url = storage.presign(key, SIGNED_URL_TTL)
+            _remember(role, key, url, expires_at)
+            result[i] = url
+            to_store[f"{CACHE_PREFIX}:{role}:{key}"] = f"{url}|{expires_at}"
+
+        if to_store:
+            async with redis_conn.pipeline(transaction=False) as pipe:
+                for redis_key, value in to_store.items():
+                    pipe.setex(redis_key, SIGNED_URL_TTL - REFRESH_MARGIN, value)
+                await pipe.execute()
+
+    return result
@@ -1,66 +1,128 @@
-import asyncio
-from googleapiclient.discovery import build
+import hashlib
+import json
+import re
+import isodate
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 import os
+from app.db.queue_connection import redis_conn
+from .clients import get_http_client
 
 load_dotenv()
 
-YOUTUBE_API_SERVICE_NAME = "youtube"
-YOUTUBE_API_VERSION = "v3"
+YOUTUBE_API_BASE_URL = "https://www.googleapis.com/youtube/v3"
+YOUTUBE_API_KEY = os.getenv("YOUTUBE_API_KEY")
 
-async def fetch_top_videos(query: str, search_limit: int = 10) -> str:
+# Results are cached per normalized title so popular topics skip the API
+SEARCH_CACHE_PREFIX = "yt_search"
+SEARCH_CACHE_TTL = int(os.getenv("YOUTUBE_CACHE_TTL", str(12 * 3600)))
+
+# Data API quota cost per call (units), tracked per Pacific-time day like Google does
+QUOTA_COSTS = {"search": 100, "videos": 1}
+QUOTA_KEY_PREFIX = "yt_quota"
+DAILY_QUOTA = int(os.getenv("YOUTUBE_DAILY_QUOTA", "10000"))
+
+
+def _quota_key() -> str:
+    # Quota resets at midnight Pacific; UTC-8 is close enough for accounting
+    day = datetime.now(timezone.utc).timestamp() - 8 * 3600
+    return f"{QUOTA_KEY_PREFIX}:{datetime.fromtimestamp(day, timezone.utc):%Y-%m-%d}"
+
+
+async def quota_used_today() -> int:
+    return int(await redis_conn.get(_quota_key()) or 0)
+
+
+async def _youtube_get(resource: str, params: dict) -> dict:
+    """Call a YouTube Data API v3 endpoint over the shared async HTTP pool."""
+    cost = QUOTA_COSTS.get(resource, 1)
+    key = _quota_key()
+    async with redis_conn.pipeline(transaction=False) as pipe:
+        pipe.incrby(key, cost)
+        pipe.expire(key, 2 * 24 * 3600)
+        used, _ = await pipe.execute()
+    print(f"[YouTube] {resource}.list used {cost} units ({used}/{DAILY_QUOTA} today)")
+
+    resp = await get_http_client().get(
+        f"{YOUTUBE_API_BASE_URL}/{resource}",
+        params={**params, "key": YOUTUBE_API_KEY},
+    )
+    resp.raise_for_status()
+    return resp.json()
+
+
+def _search_cache_key(query: str, search_limit: int) -> str:
+    normalized = re.sub(r"\s+", " ", query.strip().lower())
+    digest = hashlib.sha256(f"{normalized}|{search_limit}".encode()).hexdigest()
+    return f"{SEARCH_CACHE_PREFIX}:{digest}"
+
+
+async def search_thumbnail_candidates(query: str, search_limit: int = 10) -> list[dict]:
     """
-    Fetches the thumbnail URL of the YouTube video (non-Shorts) with the highest views for a query.
+    Non-Shorts videos for `query`, most viewed first, as
+    {"video_id", "title", "view_count", "thumbnail_url"} dicts. Cached in
+    Redis for YOUTUBE_CACHE_TTL seconds; a cache hit costs no quota.
     """
-    youtube = build(
-        YOUTUBE_API_SERVICE_NAME,
-        YOUTUBE_API_VERSION,
-        developerKey=os.getenv("YOUTUBE_API_KEY")
-    )
+    cache_key = _search_cache_key(query, search_limit)
+    cached = await redis_conn.get(cache_key)
+    if cached is not None:
+        return json.loads(cached)
+
+    # A search plus its stats lookup costs 101 units; skip references rather than hit a 403
+    if await quota_used_today() + QUOTA_COSTS["search"] + QUOTA_COSTS["videos"] > DAILY_QUOTA:
+        print(f"[YouTube] Daily quota exhausted, skipping search for: {query}")
+        return []
 
     # Step 1: Search videos by query
-    search_response = youtube.search().list(
-        q=query,
-        part="snippet",
-        type="video",
-        maxResults=search_limit
-    ).execute()
-
-    video_ids = [item["id"]["videoId"] for item in search_response["items"]]
-    if not video_ids:
-        return None
+    search_response = await _youtube_get("search", {
+        "q": query,
+        "part": "snippet",
+        "type": "video",
+        "maxResults": search_limit,
+    })
 
-    # Step 2: Fetch video statistics and content details
-    stats_response = youtube.videos().list(
-        part="statistics,contentDetails,snippet",
-        id=",".join(video_ids)
-    ).execute()
-
-    # Step 3: Filter out Shorts (duration <= 60s)
-    non_shorts = []
-    for video in stats_response["items"]:
-        duration = video["contentDetails"]["duration"]  # ISO 8601 format
-        # Convert duration to seconds
-        import isodate
-        seconds = isodate.parse_duration(duration).total_seconds()
-        if seconds > 60:
-            non_shorts.append(video)
-
-    if not non_shorts:
-        return None
+    video_ids = [item["id"]["videoId"] for item in search_response.get("items", [])]
+    candidates = []
+    if video_ids:
+        # Step 2: Fetch video statistics and content details
+        stats_response = await _youtube_get("videos", {
+            "part": "statistics,contentDetails,snippet",
+            "id": ",".join(video_ids),
+        })
 
-    # Step 4: Find the video with max views
-    max_view_video = max(
-        non_shorts,
-        key=lambda x: int(x["statistics"].get("viewCount", 0))
-    )
+        # Step 3: Filter out Shorts (duration <= 60s)
+        for video in stats_response.get("items", []):
+            duration = video["contentDetails"]["duration"]  # ISO 8601 format
+            if isodate.parse_duration(duration).total_seconds() <= 60:
+                continue
+            thumbnails = video["snippet"]["thumbnails"]
+            best = thumbnails.get("high") or thumbnails.get("medium") or thumbnails.get("default")
+            candidates.append({
+                "video_id": video["id"],
+                "title": video["snippet"]["title"],
+                "view_count": int(video["statistics"].get("viewCount", 0)),
+                "thumbnail_url": best["url"] if best else None,
+            })
 
-    print(
-        "Max views video:", 
-        max_view_video["snippet"]["title"], 
-        max_view_video["statistics"].get("viewCount", 0)
-    )
-    return max_view_video["snippet"]["thumbnails"]["high"]["url"]
+        # Step 4: Most viewed first
+        candidates.sort(key=lambda v: v["view_count"], reverse=True)
+
+    # Empty results are cached too, so unlucky queries don't keep burning quota
+    await redis_conn.setex(cache_key, SEARCH_CACHE_TTL, json.dumps(candidates))
+    return candidates
 
 
+async def fetch_top_videos(query: str, search_limit: int = 10, top_k: int | None = None):
+    """
+    Fetches the thumbnail URL of the YouTube video (non-Shorts) with the highest views for a query.
+    With `top_k`, returns the thumbnail URLs of the `top_k` most viewed videos instead.
+    """
+    candidates = [c for c in await search_thumbnail_candidates(query, search_limit) if c["thumbnail_url"]]
+    if top_k is not None:
+        return [c["thumbnail_url"] for c in candidates[:top_k]]
+    if not candidates:
+        return None
 
+    best = candidates[0]
+    print("Max views video:", best["title"], best["view_count"])
+    return best["thumbnail_url"]
@@ -1,114 +1,92 @@
-import aiohttp
+import asyncio
 import hashlib
 import json
 import base64
-import boto3
-import base64
 import os
 import time
 from datetime import datetime
+from urllib.parse import urlsplit
 from dotenv import load_dotenv
 from app.db.queue_connection import redis_conn
+from app.db.storage import get_storage
 
 load_dotenv()
 
-S3_BUCKET = os.getenv("S3_CACHED_BUCKET_NAME")
-AWS_REGION = os.getenv("AWS_REGION", "ap-south-1")
-s3 = boto3.client("s3", region_name="ap-south-1",    endpoint_url=f"https://s3.{AWS_REGION}.amazonaws.com" )
-
-
-async def compute_cache_key(prompt: str, ref_images: list, model_name: str):
-    ref_hashes = []
-    async with aiohttp.ClientSession() as session:
-        for url in ref_images:
-            async with session.get(url) as resp:
-                if resp.status == 200:
-                    img_bytes = await resp.read()
-                    ref_hashes.append(hashlib.sha256(img_bytes).hexdigest())
 
+def compute_cache_key(prompt: str, ref_hashes: list, model_name: str, **params):
+    """
+    Build the generation cache key from the prompt and the SHA-256 of each
+    reference image, as recorded at upload time. Any other inputs that change
+    the output (aspect ratio, platform, style references) go in `params`. No network I/O.
+    """
     key_data = json.dumps({
         "model": model_name,
         "prompt": prompt,
-        "ref_hashes": ref_hashes
+        "ref_hashes": ref_hashes,
+        **params,
     }, sort_keys=True)
     return hashlib.sha256(key_data.encode()).hexdigest()
 
 
-
-
-
-async def upload_to_s3(image_base64: str, job_id: str) -> str:
-    """
-    Upload image to S3 (private) and return the key (used for presigned URL)
-    """
-    image_bytes = base64.b64decode(image_base64.split(",")[-1])
-    filename = f"thumbnails/{job_id}_{int(datetime.now().timestamp())}.png"
-
-    s3.put_object(
-        Bucket=S3_BUCKET,
-        Key=filename,
-        Body=image_bytes,
-        ContentType="image/png",
-        ACL="private"  
-    )
-    return filename
-
-
-def generate_presigned_url(s3_key: str, expires_in: int = 604800) -> str:
+def reference_image_hashes(ref_images: list, ref_hashes: list | None) -> list:
     """
-    Generate a pre-signed URL valid for `expires_in` seconds
+    Content hashes for a job's reference images. Jobs created before hashes
+    were recorded fall back to the object path of each URL, which is unique
+    per upload and still stable across retries of the same job.
     """
-    url = s3.generate_presigned_url(
-        ClientMethod="get_object",
-        Params={"Bucket": S3_BUCKET, "Key": s3_key},
-        ExpiresIn=expires_in
-    )
-    return url
+    if ref_hashes and len(ref_hashes) == len(ref_images):
+        return list(ref_hashes)
+    return [urlsplit(url).path for url in ref_images]
 
 
 async def upload_to_s3_bytes(image_bytes: bytes, job_id: str, count: int) -> str:
+    """Upload generated image bytes and return the S3 key."""
     key = f"thumbnails/{job_id}_{count}_{int(datetime.now().timestamp())}.png"
-    s3.put_object(
-        Bucket=S3_BUCKET,
-        Key=key,
-        Body=image_bytes,
-        ContentType="image/png",
-        ACL="private"
-    )
-    url = s3.generate_presigned_url(
-        ClientMethod="get_object",
-        Params={"Bucket": S3_BUCKET, "Key": key},
-        ExpiresIn=604800  
-    )
-    return url
+    await get_storage("generated").put_bytes(key, image_bytes, "image/png")
+    return key
 
 
 
-def upload_base64_to_s3(image_base64: str, job_id: str) -> str:
+async def upload_base64_to_s3(image_base64: str, job_id: str) -> str:
+    """Upload a base64-encoded generated image and return the S3 key."""
     if image_base64.startswith("data:image"):
         image_base64 = image_base64.split(",")[-1]
 
-    image_bytes = base64.b64decode(image_base64)
+    image_bytes = await asyncio.to_thread(base64.b64decode, image_base64)
     key = f"thumbnails/{job_id}_{int(time.time())}.png"
+    await get_storage("generated").put_bytes(key, image_bytes, "image/png")
+    return key
 
-    s3.put_object(
-        Bucket=S3_BUCKET,
-        Key=key,
-        Body=image_bytes,
-        ContentType="image/png",
-        ACL="private"
-    )
 
-    url = s3.generate_presigned_url(
-        ClientMethod="get_object",
-        Params={"Bucket": S3_BUCKET, "Key": key},
-        ExpiresIn=604800
-    )
-    return url, key
 
+CHANNEL = "thumbnail_updates"
+EVENTS_PREFIX = "job_events"
+JOB_EVENTS_MAXLEN = int(os.getenv("JOB_EVENTS_MAXLEN", "50"))
+JOB_EVENTS_TTL = int(os.getenv("JOB_EVENTS_TTL", str(24 * 3600)))
 
 
-CHANNEL = "thumbnail_updates"
+def job_channel(job_id: str) -> str:
+    """Per-job pub/sub channel, so gateways only receive jobs they serve."""
+    return f"{CHANNEL}:{job_id}"
+
+
+def job_events_key(job_id: str) -> str:
+    """Capped per-job stream holding every update, for replay on connect."""
+    return f"{EVENTS_PREFIX}:{job_id}"
+
+
+# Append to the job's stream and publish in one step, so a subscriber can
+# never see a live event that is missing from the log. The stream entry id
+# is spliced into the published JSON object as "event_id".
+# KEYS: stream, channel  ARGV: payload, maxlen, ttl
+_APPEND_AND_PUBLISH_SCRIPT = """
+local id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[2], '*', 'data', ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('PUBLISH', KEYS[2], string.sub(ARGV[1], 1, -2) .. ',"event_id":"' .. id .. '"}')
+return id
+"""
+_append_and_publish = redis_conn.register_script(_APPEND_AND_PUBLISH_SCRIPT)
+
 
 async def publish_job_update(
     job_id: str,
@@ -119,6 +97,9 @@ async def publish_job_update(
 ):
     """
     Publishes structured job updates to Redis for frontend real-time updates.
+    Each update is also appended to the job's event stream so late-joining
+    clients can replay it. `generated_images` are S3 keys; the WebSocket
+    gateway signs them on delivery.
     """
     payload = {
         "job_id": job_id,
@@ -128,5 +109,8 @@ async def publish_job_update(
         "generated_images": generated_images or []  
     }
 
-    await redis_conn.publish(CHANNEL, json.dumps(payload))
-    print(f"[Worker] Published update: {payload}")
+    event_id = await _append_and_publish(
+        keys=[job_events_key(job_id), job_channel(job_id)],
+        args=[json.dumps(payload), JOB_EVENTS_MAXLEN, JOB_EVENTS_TTL],
+    )
+    print(f"[Worker] Published update {event_id}: {payload}")
@@ -1,8 +1,18 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from app.routes import upload,download,latest_image
+from app.routes import upload,download,latest_image,history
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.staticfiles import StaticFiles
+from app.db.storage import STORAGE_BACKEND, LOCAL_STORAGE_ROOT
+from app.services.clients import close_clients
+from app.db.repository import db_stats
+from app.services.refine_cache import refine_cache_stats
+from app.services.credit_ledger import credit_flush_loop, flush_credits
+from app.utils.helper import job_channel, job_events_key
+from app.services.request_coalescing import stream_job_id
+from app.services.url_signer import sign_urls
 import asyncio
 import json
+from collections import deque
 from redis.asyncio import Redis
 import os
 import logging
@@ -33,12 +43,17 @@ app.add_middleware(
 app.include_router(upload.router, prefix="/api", tags=["Upload"])
 app.include_router(download.router, prefix="/api", tags=["Download"])
 app.include_router(latest_image.router, prefix="/api", tags=["Latest Image"])
+app.include_router(history.router, prefix="/api", tags=["History"])
+
+# Serve the filesystem storage backend when running without S3
+if STORAGE_BACKEND == "local":
+    os.makedirs(LOCAL_STORAGE_ROOT, exist_ok=True)
+    app.mount("/local-storage", StaticFiles(directory=LOCAL_STORAGE_ROOT), name="local-storage")
 # --------------------------
 # Redis (Upstash) Setup
 # --------------------------
 REDIS_URL = os.getenv("REDIS_URL")
 redis_conn = Redis.from_url(REDIS_URL, decode_responses=True)
-CHANNEL = "thumbnail_updates"
 
 # --------------------------
 # Logging setup
@@ -46,66 +61,321 @@ CHANNEL = "thumbnail_updates"
 logger = logging.getLogger("coverly.websocket")
 logger.setLevel(logging.INFO)
 
+# --------------------------
+# Client Connections
+# --------------------------
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", "16"))
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+WS_HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_INTERVAL", "20"))
+WS_REPLAY_LIMIT = int(os.getenv("WS_REPLAY_LIMIT", "50"))
+TERMINAL_STATUSES = {"completed", "failed"}
+
+ws_metrics = {
+    "connections": 0,
+    "messages_enqueued": 0,
+    "messages_sent": 0,
+    "messages_coalesced": 0,
+    "messages_dropped": 0,
+    "slow_clients_closed": 0,
+}
+
+
+class ClientConnection:
+    """
+    One connected WebSocket with its own bounded outbound queue and writer
+    task, so a slow client only ever delays itself. Pending progress updates
+    are coalesced: a newer one replaces any older one still queued, while
+    terminal updates are always delivered.
+    """
+
+    def __init__(self, ws: WebSocket, job_id: str):
+        self.ws = ws
+        self.job_id = job_id
+        self.queue: deque[dict] = deque()
+        self.wakeup = asyncio.Event()
+        self.closed = False
+        self.writer: asyncio.Task | None = None
+
+    def start(self, backlog: list[dict], last_event_id: str | None = None):
+        """
+        Begin delivery: replayed events first, then any live events that
+        arrived during the replay and are newer than the last replayed one.
+        """
+        floor = backlog[-1]["event_id"] if backlog else last_event_id
+        live = [
+            m for m in self.queue
+            if floor is None or "event_id" not in m or _event_seq(m["event_id"]) > _event_seq(floor)
+        ]
+        self.queue = deque(backlog + live)
+        self.writer = asyncio.create_task(self._write_loop())
+        if self.queue:
+            self.wakeup.set()
+
+    @staticmethod
+    def _is_progress(data: dict) -> bool:
+        return "status" in data and data.get("status") not in TERMINAL_STATUSES
+
+    def offer(self, data: dict):
+        """Queue a message without blocking the caller."""
+        if self.closed:
+            return
+        if self._is_progress(data):
+            stale = [m for m in self.queue if self._is_progress(m)]
+            for message in stale:
+                self.queue.remove(message)
+            ws_metrics["messages_coalesced"] += len(stale)
+        if len(self.queue) >= WS_QUEUE_SIZE:
+            droppable = next((m for m in self.queue if m.get("status") not in TERMINAL_STATUSES), None)
+            if droppable is None:
+                # Nothing left to shed: the client is not keeping up at all
+                ws_metrics["slow_clients_closed"] += 1
+                self.close()
+                return
+            self.queue.remove(droppable)
+            ws_metrics["messages_dropped"] += 1
+        self.queue.append(data)
+        ws_metrics["messages_enqueued"] += 1
+        self.wakeup.set()
+
+    async def _write_loop(self):
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=WS_HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    # Idle: a heartbeat both keeps proxies open and surfaces dead peers
+                    self.queue.append({"type": "heartbeat"})
+                self.wakeup.clear()
+                while self.queue:
+                    message = await sign_event(self.queue.popleft())
+                    await asyncio.wait_for(self.ws.send_json(message), timeout=WS_SEND_TIMEOUT)
+                    ws_metrics["messages_sent"] += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.info(f"Closing WebSocket for job_id={self.job_id}: {e}")
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.writer:
+            self.writer.cancel()
+        asyncio.create_task(self._close_socket())
+
+    async def _close_socket(self):
+        try:
+            await self.ws.close()
+        except Exception:
+            pass
+
+
+def _event_seq(event_id: str) -> tuple[int, int]:
+    ms, _, seq = event_id.partition("-")
+    return int(ms), int(seq or 0)
+
+
+async def sign_event(event: dict) -> dict:
+    """
+    Events carry S3 keys; each connection's writer signs them as they go
+    out, so a replay hours after the job finished still hands the client
+    live links, and slow signing only delays that one client.
+    """
+    if not event.get("generated_images"):
+        return event
+    try:
+        return {**event, "generated_images": await sign_urls(event["generated_images"])}
+    except Exception as e:
+        logger.warning(f"Could not sign images for job_id={event.get('job_id')}: {e}")
+        return {**event, "generated_images": []}
+
+
+async def load_backlog(job_id: str, last_event_id: str | None) -> tuple[list[dict], str | None]:
+    """
+    Events a (re)connecting client has missed: everything after
+    `last_event_id` when resuming, otherwise the latest state plus every
+    "completed" event, since with generator "both" each provider completes
+    with its own images. Also returns `last_event_id`, or None if it was invalid.
+    """
+    key = job_events_key(job_id)
+    entries = []
+    if last_event_id:
+        try:
+            _event_seq(last_event_id)
+            entries = await redis_conn.xrange(key, min=f"({last_event_id}", max="+", count=WS_REPLAY_LIMIT)
+        except Exception as e:
+            logger.warning(f"Invalid last_event_id={last_event_id} for job_id={job_id}: {e}")
+            last_event_id = None
+    if not last_event_id:
+        entries = (await redis_conn.xrevrange(key, max="+", min="-", count=WS_REPLAY_LIMIT))[::-1]
+        entries = [
+            (entry_id, fields) for i, (entry_id, fields) in enumerate(entries)
+            if i == len(entries) - 1 or json.loads(fields["data"]).get("status") == "completed"
+        ]
+    return [{**json.loads(fields["data"]), "event_id": entry_id} for entry_id, fields in entries], last_event_id
+
+
 # Each job_id has a set of connected WebSocket clients
-clients_by_job: dict[str, set[WebSocket]] = {}
+clients_by_job: dict[str, set[ClientConnection]] = {}
+
+# One pub/sub connection per instance, subscribed only to the channels of
+# jobs that have a client connected here
+pubsub = redis_conn.pubsub()
+has_subscriptions = asyncio.Event()
+
+
+# channel -> event set by the subscriber loop when Redis confirms the subscription
+pending_subscriptions: dict[str, asyncio.Event] = {}
+
+
+async def subscribe_job(job_id: str):
+    """Subscribe to a job's channel and wait until Redis has confirmed it."""
+    channel = job_channel(job_id)
+    pending_subscriptions[channel] = asyncio.Event()
+    await pubsub.subscribe(channel)
+    has_subscriptions.set()
+    try:
+        await wait_subscribed(job_id)
+    finally:
+        pending_subscriptions.pop(channel, None)
+
+
+async def wait_subscribed(job_id: str):
+    """Wait for an in-progress subscription to the job's channel, if any."""
+    channel = job_channel(job_id)
+    confirmed = pending_subscriptions.get(channel)
+    if confirmed is None:
+        return
+    try:
+        await asyncio.wait_for(confirmed.wait(), timeout=2)
+    except asyncio.TimeoutError:
+        logger.warning(f"Subscription to {channel} not confirmed yet")
+
+
+async def unsubscribe_job(job_id: str):
+    await pubsub.unsubscribe(job_channel(job_id))
 
 # --------------------------
 # WebSocket Endpoint
 # --------------------------
 @app.websocket("/ws/thumbnail/{job_id}")
-async def websocket_endpoint(ws: WebSocket, job_id: str):
-    """Each WebSocket listens for updates for a specific job_id."""
+async def websocket_endpoint(ws: WebSocket, job_id: str, last_event_id: str | None = None):
+    """
+    Each WebSocket listens for updates for a specific job_id. On connect the
+    client first gets the job's latest state (or, with `last_event_id`,
+    every event after it) from the job's event stream, then live updates.
+    """
     await ws.accept()
+    # Jobs coalesced onto another user's identical job follow that job's stream
+    job_id = await stream_job_id(job_id)
     logger.info(f"🔌 WebSocket connected for job_id={job_id}")
 
-    clients_by_job.setdefault(job_id, set()).add(ws)
+    conn = ClientConnection(ws, job_id)
+    ws_metrics["connections"] += 1
+    clients = clients_by_job.setdefault(job_id, set())
+    first_client = not clients
+    clients.add(conn)
 
     try:
-        while True:
-            # Keep alive or listen for ping/pong
-            await asyncio.sleep(20)
-    except WebSocketDisconnect:
-        logger.info(f"❌ WebSocket disconnected for job_id={job_id}")
+        # Subscribe (confirmed) before reading the log so nothing published in
+        # between is lost; start() drops live events the replay already covered
+        if first_client:
+            await subscribe_job(job_id)
+        else:
+            await wait_subscribed(job_id)
+        backlog, last_event_id = await load_backlog(job_id, last_event_id)
+        conn.start(backlog, last_event_id)
+        # Read side: notices client closes right away and answers app-level pings
+        while not conn.closed:
+            message = await ws.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if message.get("text") == "ping":
+                conn.offer({"type": "pong"})
+    except (WebSocketDisconnect, RuntimeError):
+        pass  # RuntimeError: socket already closed by the writer
     finally:
-        clients_by_job[job_id].discard(ws)
-        if not clients_by_job[job_id]:
-            clients_by_job.pop(job_id, None)
+        logger.info(f"❌ WebSocket disconnected for job_id={job_id}")
+        ws_metrics["connections"] -= 1
+        conn.close()
+        await remove_client(job_id, conn)
+
+
+async def remove_client(job_id: str, conn: ClientConnection):
+    """Drop a client; the last one to leave a job unsubscribes its channel."""
+    clients = clients_by_job.get(job_id)
+    if clients is None:
+        return
+    clients.discard(conn)
+    if not clients:
+        clients_by_job.pop(job_id, None)
+        try:
+            await unsubscribe_job(job_id)
+        except Exception as e:
+            logger.warning(f"Unsubscribe failed for job_id={job_id}: {e}")
+
+
+@app.get("/db/metrics")
+def database_metrics():
+    """Per-query call counts and latencies for this process."""
+    return db_stats()
+
+
+@app.get("/refine-cache/metrics")
+async def refine_cache_metrics():
+    """Prompt refinement cache hits and misses across all workers."""
+    return await refine_cache_stats()
+
+
+@app.get("/ws/metrics")
+def websocket_metrics():
+    """Gateway counters plus current outbound queue depths."""
+    depths = [len(c.queue) for conns in clients_by_job.values() for c in conns]
+    return {
+        **ws_metrics,
+        "jobs_subscribed": len(clients_by_job),
+        "queued_messages": sum(depths),
+        "max_queue_depth": max(depths, default=0),
+    }
 
 # --------------------------
 # Redis Subscriber
 # --------------------------
-async def redis_subscriber():
-    """Listen for published thumbnail updates and forward them to WebSocket clients."""
-    pubsub = redis_conn.pubsub()
-    await pubsub.subscribe(CHANNEL)
-    logger.info(f"🧠 Subscribed to Redis channel: {CHANNEL}")
+def broadcast(job_id: str, data: dict):
+    """Hand one update to every client for the job; never waits on a socket."""
+    for conn in list(clients_by_job.get(job_id, ())):
+        conn.offer(data)
 
+
+async def redis_subscriber():
+    """
+    Push-driven: blocks on the pub/sub connection while any job channel is
+    subscribed, and parks on an event while none are.
+    """
+    logger.info("🧠 Redis subscriber waiting for job subscriptions")
     while True:
+        await has_subscriptions.wait()
         try:
-            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1)
-            if message and "data" in message:
+            async for message in pubsub.listen():
+                if message.get("type") == "subscribe":
+                    confirmed = pending_subscriptions.get(message["channel"])
+                    if confirmed:
+                        confirmed.set()
+                    continue
+                if message.get("type") != "message":
+                    continue
                 try:
                     data = json.loads(message["data"])
-                    job_id = data.get("job_id")
-                    if not job_id:
-                        continue  # skip malformed payloads
-
-                    if job_id in clients_by_job:
-                        # broadcast to all connected clients for this job_id
-                        disconnected = []
-                        for ws in list(clients_by_job[job_id]):
-                            try:
-                                await ws.send_json(data)
-                            except Exception:
-                                disconnected.append(ws)
-
-                        for ws in disconnected:
-                            clients_by_job[job_id].discard(ws)
-                        if not clients_by_job[job_id]:
-                            clients_by_job.pop(job_id, None)
                 except json.JSONDecodeError:
                     logger.warning("⚠️ Received invalid JSON from Redis.")
-            await asyncio.sleep(0.05)
+                    continue
+                job_id = data.get("job_id")
+                if job_id:
+                    broadcast(job_id, data)
+            # listen() returns once the last channel is unsubscribed
+            if not pubsub.subscribed:
+                has_subscriptions.clear()
         except Exception as e:
             logger.error(f"Redis subscriber error: {e}")
             await asyncio.sleep(1)
@@ -113,4 +383,15 @@ async def redis_subscriber():
 @app.on_event("startup")
 async def startup_event():
     asyncio.create_task(redis_subscriber())
+    asyncio.create_task(credit_flush_loop())
     logger.info("🚀 WebSocket + Redis subscriber started.")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await pubsub.aclose()
+    try:
+        await flush_credits()
+    except Exception as e:
+        logger.error(f"Final credit flush failed: {e}")
+    await close_clients()